@@ -57,12 +57,12 @@ def read_cifar10(cifar_folder, new_size=(32, 32), validation=0.2, shuffle=False)
 
 
 def reshape_cifar(cifar_numpy_array, new_size=(32, 32)):
-    from scipy import misc
+    from .utils import imresize
     data = []
     for i in tqdm.tqdm(range(cifar_numpy_array.shape[0]), unit='images'):
-        r = misc.imresize(np.reshape(cifar_numpy_array[i, 0], (32, 32)), new_size)
-        g = misc.imresize(np.reshape(cifar_numpy_array[i, 1], (32, 32)), new_size)
-        b = misc.imresize(np.reshape(cifar_numpy_array[i, 2], (32, 32)), new_size)
+        r = imresize(np.reshape(cifar_numpy_array[i, 0], (32, 32)), new_size)
+        g = imresize(np.reshape(cifar_numpy_array[i, 1], (32, 32)), new_size)
+        b = imresize(np.reshape(cifar_numpy_array[i, 2], (32, 32)), new_size)
         data.append(np.dstack((r, g, b)))
     return np.transpose(np.array(data, dtype='float32'), (0, 3, 1, 2))
 
@@ -1466,7 +1466,8 @@ class SpatialTransformerLayer(Layer):
                                                                      1])) if self.dnn else utils.transform_affine(theta,
                                                                                                                   input,
                                                                                                                   self.downsample_factor,
-                                                                                                                  self.border_mode)
+                                                                                                                  self.border_mode,
+                                                                                                                  self.input_shape)
 
 
 class WarpingLayer(Layer):
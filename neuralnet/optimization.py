@@ -7,7 +7,9 @@ Major updates on Sep 8, 2017: All algorithms now return updates in OrderedDict (
 '''
 
 import abc
+import functools
 import sys
+import weakref
 from collections import OrderedDict
 
 import numpy as np
@@ -18,13 +20,33 @@ from .layers import NetMethod
 
 sys.setrecursionlimit(10000)
 __all__ = ['sgd', 'sgdmomentum', 'adadelta', 'adagrad', 'adam', 'adamax', 'nadam', 'rmsprop', 'amsgrad',
-           'anneal_learning_rate', 'optimizer']
+           'anneal_learning_rate', 'LRSchedule', 'optimizer', 'step_function', 'clear_step_cache']
 
 
 class Optimizer(NetMethod, metaclass=abc.ABCMeta):
-    def __init__(self, alpha, **kwargs):
-        self.alpha = T.cast(alpha, theano.config.floatX)
+    numba_kernel = None
+    num_host_states = 0
+
+    def __init__(self, alpha, engine='theano', freeze_hyperparams=True, **kwargs):
+        if engine not in ('theano', 'numba'):
+            raise ValueError('engine must be \'theano\' or \'numba\', got %s.' % engine)
+        if engine == 'numba':
+            if self.numba_kernel is None:
+                raise NotImplementedError('%s does not support engine=\'numba\'.' % self.__class__.__name__)
+            try:
+                import numba
+            except ImportError as e:
+                raise ImportError('engine=\'numba\' requires Numba. Install it with `pip install neuralnet[numba]`.') \
+                    from e
+
+        self.freeze_hyperparams = freeze_hyperparams
+        self.alpha = _hyperparameter(alpha, 'alpha', freeze_hyperparams)
+        self.engine = engine
         self.params = []
+        self.powers = []
+        self.host_hyperparams = ()
+        self.host_states = None
+        self.host_time = 0
         self.descriptions = None
 
     @abc.abstractmethod
@@ -34,6 +56,202 @@ class Optimizer(NetMethod, metaclass=abc.ABCMeta):
     def get_output(self, params, grads):
         return self.get_updates(params, grads)
 
+    def host_args(self, t):
+        """Returns the scalar arguments of `numba_kernel` at time step `t`."""
+        return tuple(_host_value(var) for var in self.host_hyperparams)
+
+    def apply(self, params, grads):
+        """
+        Performs one update step on the host with the Numba kernels in `optimization_numba`.
+        Only available when the optimizer is created with `engine='numba'` and the parameters live on the CPU.
+
+        :param params: a list of shared variables
+        :param grads: a list of numpy arrays holding the gradients of the cost w.r.t. `params`
+        """
+        if self.engine != 'numba':
+            raise NotImplementedError('apply requires an optimizer created with engine=\'numba\'.')
+
+        from . import optimization_numba
+        kernel = getattr(optimization_numba, self.numba_kernel)
+        values = [np.ascontiguousarray(param.get_value(borrow=True)) for param in params]
+        if self.host_states is None:
+            size = sum(value.size for value in values)
+            self.host_states = [np.zeros((size,), theano.config.floatX) for _ in range(self.num_host_states)]
+
+        self.host_time += 1
+        args = self.host_args(self.host_time)
+        start = 0
+        for param, value, grad in zip(params, values, grads):
+            stop = start + value.size
+            states = [state[start:stop] for state in self.host_states]
+            kernel(value.reshape(-1), np.asarray(grad, value.dtype).reshape(-1), *states, *args)
+            param.set_value(value, borrow=True)
+            start = stop
+
+    def reset(self):
+        _zero_shared(self.params)
+        for power in self.powers:
+            power.set_value(np.asarray(1., theano.config.floatX))
+        self.host_states = None
+        self.host_time = 0
+
+
+def _hyperparameter(value, name, freeze=False):
+    """
+    Wraps a hyperparameter in a floatX shared variable. Symbolic values, e.g. an annealed learning rate,
+    are used as they are.
+
+    :param value: a number or a symbolic scalar
+    :param name: name of the variable
+    :param freeze: if True, a number is turned into a constant instead, which is baked into the compiled code
+    :return: a symbolic scalar of type floatX
+    """
+    if isinstance(value, theano.Variable):
+        return T.cast(value, theano.config.floatX)
+    if freeze:
+        return T.constant(np.asarray(value, theano.config.floatX), name=name)
+    return theano.shared(np.asarray(value, theano.config.floatX), name)
+
+
+def _host_value(var):
+    """
+    Reads the current value of a hyperparameter made by `_hyperparameter` on the host.
+
+    :param var: a constant, a shared variable, or a cast of either
+    :return: a Python float
+    """
+    if var.owner is not None and isinstance(var.owner.op, T.Elemwise) and \
+            isinstance(var.owner.op.scalar_op, theano.scalar.Cast):
+        return _host_value(var.owner.inputs[0])
+    if isinstance(var, theano.compile.SharedVariable):
+        return float(var.get_value())
+    if isinstance(var, T.TensorConstant):
+        return float(var.data)
+    raise TypeError('engine=\'numba\' requires numeric or shared hyperparameters, got %s.' % var)
+
+
+def _zeros_like_device(shape, dtype, value):
+    """
+    Allocates zeros on the device holding `value`, without staging them on the host.
+
+    :param shape: shape of the array
+    :param dtype: data type of the array
+    :param value: a numpy or pygpu array
+    :return: a numpy array if `value` is one, otherwise a pygpu array on the same context
+    """
+    if isinstance(value, np.ndarray):
+        return np.zeros(shape, dtype)
+
+    import pygpu
+    return pygpu.gpuarray.zeros(shape, dtype, context=value.context)
+
+
+def _zero_shared(shared_vars):
+    """
+    Fills shared variables with zeros without copying their values to the host.
+    Values living on the GPU are replaced by zero arrays allocated on the same device.
+
+    :param shared_vars: a list of shared variables
+    """
+    for var in shared_vars:
+        value = var.get_value(borrow=True, return_internal_type=True)
+        var.set_value(_zeros_like_device(value.shape, var.dtype, value), borrow=True)
+
+
+def _flat_zeros(params, name, dtype=theano.config.floatX):
+    """
+    Allocates one contiguous zero vector holding a state slot for every parameter.
+    The optimizers update each parameter on its own view of the buffer. Stacking parameters, whether all of them or
+    groups of the same shape, would copy every parameter and gradient on each step.
+
+    :param params: a list of shared variables
+    :param name: name of the flat shared variable
+    :param dtype: data type of the buffer
+    :return: the flat shared variable and a list of its slices reshaped like `params`
+    """
+    values = [param.get_value(borrow=True, return_internal_type=True) for param in params]
+    size = sum(int(np.prod(value.shape)) for value in values)
+    if values and not isinstance(values[0], np.ndarray):
+        zeros = _zeros_like_device((size,), dtype, values[0])
+        flat = theano.shared(zeros, name, borrow=True, target=params[0].type.context_name)
+    else:
+        flat = theano.shared(np.zeros((size,), dtype), name, borrow=True)
+    return flat, _flat_views(flat, params)
+
+
+def _flat_offsets(params):
+    """
+    Returns the shapes of `params` and the offsets of their slots in a flat state buffer.
+
+    :param params: a list of shared variables
+    :return: a list of shapes and an array of `len(params) + 1` offsets
+    """
+    shapes = [param.get_value(borrow=True, return_internal_type=True).shape for param in params]
+    return shapes, np.cumsum([0] + [int(np.prod(shape)) for shape in shapes])
+
+
+def _flat_views(flat, params):
+    """
+    Splits a flat vector into slices reshaped like `params`.
+
+    :param flat: a symbolic vector whose length is the total size of `params`
+    :param params: a list of shared variables
+    :return: a list of views of `flat`
+    """
+    shapes, offsets = _flat_offsets(params)
+    return [T.patternbroadcast(T.reshape(flat[start:stop], shape), param.broadcastable)
+            for param, shape, start, stop in zip(params, shapes, offsets[:-1], offsets[1:])]
+
+
+def _flat_update(flat, params, values):
+    """
+    Writes the new values of the per-parameter views back into a flat state buffer.
+    The writes are chained `set_subtensor`s on `flat` itself, so that the inplace optimizer can update the buffer
+    without a copy.
+
+    :param flat: a flat shared variable from `_flat_zeros`
+    :param params: the list of shared variables `flat` was allocated for
+    :param values: new values of the views of `flat`, in the same order
+    :return: a vector of the same dtype as `flat`
+    """
+    _, offsets = _flat_offsets(params)
+    flat_t = flat
+    for value, start, stop in zip(values, offsets[:-1], offsets[1:]):
+        flat_t = T.set_subtensor(flat_t[start:stop], T.flatten(T.cast(value, flat.dtype)))
+    return flat_t
+
+
+@functools.lru_cache(maxsize=None)
+def _fused_step(body, num_inputs):
+    """
+    Compiles a scalar update rule into a single multi-output Elemwise so that the whole step runs in one loop.
+
+    :param body: a function mapping `num_inputs` scalar variables to a list of scalar outputs
+    :param num_inputs: number of inputs of `body`
+    :return: an Elemwise Op
+    """
+    inputs = [theano.scalar.Scalar(theano.config.floatX)() for _ in range(num_inputs)]
+    return T.Elemwise(theano.scalar.Composite(inputs, body(*inputs)))
+
+
+def _adam_body(param, g_t, m_prev, v_prev, a_t, beta1, beta2, epsilon):
+    m_t = beta1 * m_prev + (1. - beta1) * g_t
+    v_t = beta2 * v_prev + (1. - beta2) * g_t * g_t
+    return [param - a_t * m_t / (theano.scalar.sqrt(v_t) + epsilon), m_t, v_t]
+
+
+def _adamax_body(param, g_t, m_prev, u_prev, a_t, beta1, beta2, epsilon):
+    m_t = beta1 * m_prev + (1. - beta1) * g_t
+    u_t = theano.scalar.maximum(beta2 * u_prev, theano.scalar.abs_(g_t))
+    return [param - a_t * m_t / (u_t + epsilon), m_t, u_t]
+
+
+def _amsgrad_body(param, g_t, m_prev, v_prev, v_hat_prev, a_t, beta1, beta2, epsilon):
+    m_t = beta1 * m_prev + (1. - beta1) * g_t
+    v_t = beta2 * v_prev + (1. - beta2) * g_t * g_t
+    v_hat_t = theano.scalar.maximum(v_hat_prev, v_t)
+    return [param - a_t * m_t / (theano.scalar.sqrt(v_hat_t) + epsilon), m_t, v_t, v_hat_t]
+
 
 class VanillaSGD(Optimizer):
     def __init__(self, alpha, **kwargs):
@@ -58,41 +276,43 @@ class AdaDelta(Optimizer):
         opt = AdaDelta(0.95, 1e-6)
         updates = get_updates(parameter_list, grad_list)
     """
+    numba_kernel = 'adadelta_step'
+    num_host_states = 2
 
     def __init__(self, rho=.95, epsilon=1e-6, **kwargs):
         super(AdaDelta, self).__init__(0., **kwargs)
-        self.rho = T.as_tensor_variable(np.cast[theano.config.floatX](rho))
-        self.epsilon = T.as_tensor_variable(np.cast[theano.config.floatX](epsilon))
-        self.descriptions = 'ADADELTA. RHO = {} EPSILON = {} '.format(self.rho, self.epsilon)
+        self.rho = _hyperparameter(rho, 'rho', self.freeze_hyperparams)
+        self.epsilon = _hyperparameter(epsilon, 'epsilon', self.freeze_hyperparams)
+        self.host_hyperparams = (self.rho, self.epsilon)
+        self.descriptions = 'ADADELTA. RHO = {} EPSILON = {} '.format(rho, epsilon)
         print('Using %s' % self)
 
     def get_updates(self, params, grads):
         updates = OrderedDict()
-        for param, grad in zip(params, grads):
-            value = param.get_value()
-            Eg2_i = theano.shared(np.zeros_like(value), param.name + '_grad_sqr_mva', broadcastable=param.broadcastable)
-            delta_i_prev = theano.shared(np.zeros_like(value), param.name + '_prev_grad',
-                                         broadcastable=param.broadcastable)
-            Edelx2_i = theano.shared(np.zeros_like(value), param.name + '_velo_sqr_mva',
-                                     broadcastable=param.broadcastable)
-            self.params += [Eg2_i, delta_i_prev, Edelx2_i]
-
-            delta_i = T.sqrt(Edelx2_i + self.epsilon) / T.sqrt(Eg2_i + self.epsilon) * grad
-            updates[param] = param - delta_i
-            updates[delta_i_prev] = delta_i
-            updates[Edelx2_i] = self.rho * Edelx2_i + (1. - self.rho) * delta_i ** 2
-            updates[Eg2_i] = self.rho * Eg2_i + (1. - self.rho) * grad ** 2
+        one_minus_rho = 1. - self.rho
+        Eg2, Eg2_views = _flat_zeros(params, 'grad_sqr_mva')
+        delta_prev, _ = _flat_zeros(params, 'prev_grad')
+        Edelx2, Edelx2_views = _flat_zeros(params, 'velo_sqr_mva')
+        self.params += [Eg2, delta_prev, Edelx2]
+
+        Eg2s_t, deltas, Edelx2s_t = [], [], []
+        for param, grad, Eg2_i, Edelx2_i in zip(params, grads, Eg2_views, Edelx2_views):
+            Eg2_t = self.rho * Eg2_i + one_minus_rho * T.sqr(grad)
+            delta = T.sqrt((Edelx2_i + self.epsilon) / (Eg2_t + self.epsilon)) * grad
+            updates[param] = T.cast(param - delta, param.dtype)
+            Eg2s_t.append(Eg2_t)
+            deltas.append(delta)
+            Edelx2s_t.append(self.rho * Edelx2_i + one_minus_rho * T.sqr(delta))
+        updates[delta_prev] = _flat_update(delta_prev, params, deltas)
+        updates[Edelx2] = _flat_update(Edelx2, params, Edelx2s_t)
+        updates[Eg2] = _flat_update(Eg2, params, Eg2s_t)
         return updates
 
-    def reset(self):
-        for param in self.params:
-            param.set_value(param.get_value() * np.float32(0))
-
 
 class SGDMomentum(Optimizer):
     def __init__(self, lr, mom, nesterov=False, **kwargs):
         super(SGDMomentum, self).__init__(lr, **kwargs)
-        self.alpha = T.cast(mom, dtype=theano.config.floatX)
+        self.mom = _hyperparameter(mom, 'mom', self.freeze_hyperparams)
         self.nesterov = nesterov
         self.descriptions = 'STOCHASTIC GRADIENT DESCENT MOMENTUM. ETA = {} MOMENTUM = {} NESTEROV = {}'. \
             format(lr, mom, nesterov)
@@ -100,12 +320,17 @@ class SGDMomentum(Optimizer):
 
     def get_updates(self, params, grads):
         updates = OrderedDict()
-        for param, grad in zip(params, grads):
-            updates[param] = param - self.alpha * grad
-        if not self.nesterov:
-            updates = self.apply_momentum(updates)
-        else:
-            updates = self.apply_nesterov_momentum(updates)
+        velocity, velocities = _flat_zeros(params, 'prev_velo')
+        self.params.append(velocity)
+
+        velocities_t = []
+        for param, grad, velocity_i in zip(params, grads, velocities):
+            step = -self.alpha * grad
+            velocity_t = self.mom * velocity_i + step
+            param_t = param + (self.mom * velocity_t + step if self.nesterov else velocity_t)
+            updates[param] = T.cast(param_t, param.dtype)
+            velocities_t.append(velocity_t)
+        updates[velocity] = _flat_update(velocity, params, velocities_t)
         return updates
 
     def apply_momentum(self, updates):
@@ -130,7 +355,7 @@ class SGDMomentum(Optimizer):
         Returns
         -------
         OrderedDict
-            A copy of `updates` with momentum updates for all `params`.
+            `updates`, modified in place to include momentum updates for all `params`.
 
         Notes
         -----
@@ -142,16 +367,16 @@ class SGDMomentum(Optimizer):
         momentum : Shortcut applying momentum to SGD updates
         """
         params = list(updates.keys())
-        updates = OrderedDict(updates)
 
-        for param in params:
-            value = param.get_value(borrow=True)
-            velocity = theano.shared(np.zeros_like(value), param.name + '_prev_velo', broadcastable=param.broadcastable)
-            self.params.append(velocity)
+        velocity, velocities = _flat_zeros(params, 'prev_velo')
+        self.params.append(velocity)
 
-            x = self.alpha * velocity + updates[param]
-            updates[velocity] = x - param
-            updates[param] = x
+        velocities_t = []
+        for param, velocity_i in zip(params, velocities):
+            x = self.mom * velocity_i + updates[param]
+            velocities_t.append(x - param)
+            updates[param] = T.cast(x, param.dtype)
+        updates[velocity] = _flat_update(velocity, params, velocities_t)
         return updates
 
     def apply_nesterov_momentum(self, updates):
@@ -176,7 +401,7 @@ class SGDMomentum(Optimizer):
         Returns
         -------
         OrderedDict
-            A copy of `updates` with momentum updates for all `params`.
+            `updates`, modified in place to include momentum updates for all `params`.
 
         Notes
         -----
@@ -194,160 +419,173 @@ class SGDMomentum(Optimizer):
         nesterov_momentum : Shortcut applying Nesterov momentum to SGD updates
         """
         params = list(updates.keys())
-        updates = OrderedDict(updates)
 
-        for param in params:
-            value = param.get_value(borrow=True)
-            velocity = theano.shared(np.zeros_like(value), param.name + '_prev_velo', broadcastable=param.broadcastable)
-            self.params.append(velocity)
+        velocity, velocities = _flat_zeros(params, 'prev_velo')
+        self.params.append(velocity)
 
-            x = self.alpha * velocity + updates[param] - param
-            updates[velocity] = x
-            updates[param] = self.alpha * x + updates[param]
+        velocities_t = []
+        for param, velocity_i in zip(params, velocities):
+            x = self.mom * velocity_i + updates[param] - param
+            velocities_t.append(x)
+            updates[param] = T.cast(self.mom * x + updates[param], param.dtype)
+        updates[velocity] = _flat_update(velocity, params, velocities_t)
         return updates
 
-    def reset(self):
-        for param in self.params:
-            param.set_value(param.get_value() * np.float32(0))
-
 
 class AdaGrad(Optimizer):
+    numba_kernel = 'adagrad_step'
+    num_host_states = 1
+
     def __init__(self, alpha, epsilon=1e-6, **kwargs):
         super(AdaGrad, self).__init__(alpha, **kwargs)
-        self.epsilon = T.cast(epsilon, theano.config.floatX)
+        self.epsilon = _hyperparameter(epsilon, 'epsilon', self.freeze_hyperparams)
+        self.host_hyperparams = (self.alpha, self.epsilon)
         self.descriptions = 'ADAGRAD. ETA = %s '.format(alpha)
         print('Using %s' % self)
 
     def get_updates(self, params, grads):
         updates = OrderedDict()
-        for param, grad in zip(params, grads):
-            value = param.get_value()
-            grad_prev = theano.shared(np.zeros_like(value), param.name + '_grad_sqr_sum',
-                                      broadcastable=param.broadcastable)
-            self.params.append(grad_prev)
-
-            updates[grad_prev] = grad_prev + grad ** 2
-            updates[param] = self.alpha * grad / T.sqrt(self.epsilon + grad_prev)
+        grad_sqr, grad_sqr_views = _flat_zeros(params, 'grad_sqr_sum')
+        self.params.append(grad_sqr)
+
+        grad_sqr_sums = []
+        for param, grad, grad_sqr_i in zip(params, grads, grad_sqr_views):
+            grad_sqr_sum = grad_sqr_i + T.sqr(grad)
+            updates[param] = T.cast(param - self.alpha * grad / T.sqrt(grad_sqr_sum + self.epsilon), param.dtype)
+            grad_sqr_sums.append(grad_sqr_sum)
+        updates[grad_sqr] = _flat_update(grad_sqr, params, grad_sqr_sums)
         return updates
 
-    def reset(self):
-        for param in self.params:
-            param.set_value(param.get_value() * np.float32(0))
-
 
 class RMSprop(Optimizer):
+    numba_kernel = 'rmsprop_step'
+    num_host_states = 1
+
     def __init__(self, alpha=1e-3, gamma=0.9, epsilon=1e-6, **kwargs):
         super(RMSprop, self).__init__(alpha, **kwargs)
-        self.gamma = T.cast(gamma, theano.config.floatX)
-        self.epsilon = T.cast(epsilon, theano.config.floatX)
+        self.gamma = _hyperparameter(gamma, 'gamma', self.freeze_hyperparams)
+        self.epsilon = _hyperparameter(epsilon, 'epsilon', self.freeze_hyperparams)
+        self.host_hyperparams = (self.alpha, self.gamma, self.epsilon)
         self.descriptions = 'RMSPROP. ETA = {} GAMMA = {} '.format(alpha, gamma)
         print('Using %s' % self)
 
     def get_updates(self, params, grads):
         updates = OrderedDict()
-        for param, grad in zip(params, grads):
-            value = param.get_value()
-            grad2_prev = theano.shared(np.zeros_like(value), param.name + '_grad_sqr_mva',
-                                       broadcastable=param.broadcastable)
-            self.params.append(grad2_prev)
-
-            updates[grad2_prev] = self.gamma * grad2_prev + (1. - self.gamma) * grad ** 2
-            updates[param] = param - self.alpha * grad / T.sqrt(grad2_prev + self.epsilon)
+        one_minus_gamma = 1. - self.gamma
+        grad2, grad2_views = _flat_zeros(params, 'grad_sqr_mva')
+        self.params.append(grad2)
+
+        grad2s_t = []
+        for param, grad, grad2_i in zip(params, grads, grad2_views):
+            grad2_t = self.gamma * grad2_i + one_minus_gamma * T.sqr(grad)
+            updates[param] = T.cast(param - self.alpha * grad / T.sqrt(grad2_t + self.epsilon), param.dtype)
+            grad2s_t.append(grad2_t)
+        updates[grad2] = _flat_update(grad2, params, grad2s_t)
         return updates
 
-    def reset(self):
-        for param in self.params:
-            param.set_value(param.get_value() * np.float32(0))
-
 
 class Adam(Optimizer):
-    def __init__(self, alpha=1e-3, beta1=0.9, beta2=0.999, epsilon=1e-8, **kwargs):
+    numba_kernel = 'adam_step'
+    num_host_states = 2
+
+    def __init__(self, alpha=1e-3, beta1=0.9, beta2=0.999, epsilon=1e-8, state_dtype=theano.config.floatX, **kwargs):
         super(Adam, self).__init__(alpha, **kwargs)
-        self.beta1 = T.cast(beta1, theano.config.floatX)
-        self.beta2 = T.cast(beta2, theano.config.floatX)
-        self.epsilon = epsilon
+        self.beta1 = _hyperparameter(beta1, 'beta1', self.freeze_hyperparams)
+        self.beta2 = _hyperparameter(beta2, 'beta2', self.freeze_hyperparams)
+        self.epsilon = _hyperparameter(epsilon, 'epsilon', self.freeze_hyperparams)
+        self.state_dtype = state_dtype
+        self.host_hyperparams = (self.alpha, self.beta1, self.beta2, self.epsilon)
         self.descriptions = 'ADAM. ETA = {} BETA1 = {} BETA2 = {}'.format(alpha, beta1, beta2)
         print('Using %s' % self)
 
     def get_updates(self, params, grads):
         updates = OrderedDict()
 
-        t_prev = theano.shared(np.float32(0.), 'time')
-        self.params.append(t_prev)
+        beta1_pow = theano.shared(np.asarray(1., theano.config.floatX), 'beta1_pow')
+        beta2_pow = theano.shared(np.asarray(1., theano.config.floatX), 'beta2_pow')
+        self.powers += [beta1_pow, beta2_pow]
 
         one = T.constant(1)
-        t = t_prev + 1
-        a_t = self.alpha * T.sqrt(one - self.beta2 ** t) / (one - self.beta1 ** t)
-        for param, g_t in zip(params, grads):
-            value = param.get_value(borrow=True)
-            m_prev = theano.shared(np.zeros_like(value), param.name + '_grad_mva', broadcastable=param.broadcastable)
-            v_prev = theano.shared(np.zeros_like(value), param.name + '_grad_sqr_mva',
-                                   broadcastable=param.broadcastable)
-            self.params += [m_prev, v_prev]
-
-            m_t = self.beta1 * m_prev + (one - self.beta1) * g_t
-            v_t = self.beta2 * v_prev + (one - self.beta2) * g_t ** 2
-            step = a_t * m_t / (T.sqrt(v_t) + self.epsilon)
-
-            updates[m_prev] = m_t
-            updates[v_prev] = v_t
-            updates[param] = param - step
-
-        updates[t_prev] = t
+        beta1_pow_t = beta1_pow * self.beta1
+        beta2_pow_t = beta2_pow * self.beta2
+        a_t = self.alpha * T.sqrt(one - beta2_pow_t) / (one - beta1_pow_t)
+        m, m_views = _flat_zeros(params, 'grad_mva')
+        v, v_views = _flat_zeros(params, 'grad_sqr_mva', self.state_dtype)
+        self.params += [m, v]
+        updates[beta1_pow] = beta1_pow_t
+        updates[beta2_pow] = beta2_pow_t
+
+        floatX = theano.config.floatX
+        use_cuda_kernel = theano.config.device.startswith('cuda') and floatX == self.state_dtype == 'float32'
+        if use_cuda_kernel:
+            from .optimization_cuda import gpu_adam_step
+        step = _fused_step(_adam_body, 8)
+
+        ms_t, vs_t = [], []
+        for param, grad, m_i, v_i in zip(params, grads, m_views, v_views):
+            if use_cuda_kernel and param.dtype == grad.dtype == 'float32':
+                param_t, m_t, v_t = gpu_adam_step(T.flatten(param), T.flatten(grad), T.flatten(m_i), T.flatten(v_i),
+                                                  a_t, self.beta1, self.beta2, self.epsilon)
+                param_t = T.patternbroadcast(T.reshape(param_t, param.shape, param.ndim), param.broadcastable)
+            else:
+                param_t, m_t, v_t = step(T.cast(param, floatX), T.cast(grad, floatX), m_i, T.cast(v_i, floatX),
+                                         T.cast(a_t, floatX), self.beta1, self.beta2, self.epsilon)
+            updates[param] = T.cast(param_t, param.dtype)
+            ms_t.append(m_t)
+            vs_t.append(v_t)
+        updates[m] = _flat_update(m, params, ms_t)
+        updates[v] = _flat_update(v, params, vs_t)
         return updates
 
-    def reset(self):
-        for param in self.params:
-            param.set_value(param.get_value() * np.float32(0))
+    def host_args(self, t):
+        alpha, beta1, beta2, epsilon = super(Adam, self).host_args(t)
+        a_t = alpha * np.sqrt(1. - beta2 ** t) / (1. - beta1 ** t)
+        return a_t, beta1, beta2, epsilon
 
 
 class AdaMax(Optimizer):
     def __init__(self, alpha=2e-3, beta1=0.9, beta2=0.999, epsilon=1e-8, **kwargs):
         super(AdaMax, self).__init__(alpha, **kwargs)
-        self.beta1 = T.cast(beta1, theano.config.floatX)
-        self.beta2 = T.cast(beta2, theano.config.floatX)
-        self.epsilon = T.cast(epsilon, theano.config.floatX)
+        self.beta1 = _hyperparameter(beta1, 'beta1', self.freeze_hyperparams)
+        self.beta2 = _hyperparameter(beta2, 'beta2', self.freeze_hyperparams)
+        self.epsilon = _hyperparameter(epsilon, 'epsilon', self.freeze_hyperparams)
         self.descriptions = 'ADAMAX. ETA = {} BETA1 = {} BETA2 = {}'.format(alpha, beta1, beta2)
         print('Using %s' % self)
 
     def get_updates(self, params, grads):
         updates = OrderedDict()
-        t_prev = theano.shared(np.float32(0.))
-        self.params.append(t_prev)
+        beta1_pow = theano.shared(np.asarray(1., theano.config.floatX), 'beta1_pow')
+        self.powers.append(beta1_pow)
 
         one = T.constant(1)
-        t = t_prev + 1
-        a_t = self.alpha / (one - self.beta1 ** t)
-        for param, g_t in zip(params, grads):
-            value = param.get_value(borrow=True)
-            m_prev = theano.shared(np.zeros_like(value), param.name + '_grad_mva', broadcastable=param.broadcastable)
-            u_prev = theano.shared(np.zeros_like(value), param.name + '_abs_grad_mva',
-                                   broadcastable=param.broadcastable)
-            self.params += [m_prev, u_prev]
-
-            m_t = self.beta1 * m_prev + (one - self.beta1) * g_t
-            u_t = T.maximum(self.beta2 * u_prev, abs(g_t))
-            step = a_t * m_t / (u_t + self.epsilon)
-
-            updates[m_prev] = m_t
-            updates[u_prev] = u_t
-            updates[param] = param - step
-
-        updates[t_prev] = t
+        beta1_pow_t = beta1_pow * self.beta1
+        a_t = self.alpha / (one - beta1_pow_t)
+        m, m_views = _flat_zeros(params, 'grad_mva')
+        u, u_views = _flat_zeros(params, 'abs_grad_mva')
+        self.params += [m, u]
+
+        step = _fused_step(_adamax_body, 8)
+        floatX = theano.config.floatX
+        ms_t, us_t = [], []
+        for param, grad, m_i, u_i in zip(params, grads, m_views, u_views):
+            param_t, m_t, u_t = step(T.cast(param, floatX), T.cast(grad, floatX), m_i, u_i, T.cast(a_t, floatX),
+                                     self.beta1, self.beta2, self.epsilon)
+            updates[param] = T.cast(param_t, param.dtype)
+            ms_t.append(m_t)
+            us_t.append(u_t)
+        updates[m] = _flat_update(m, params, ms_t)
+        updates[u] = _flat_update(u, params, us_t)
+        updates[beta1_pow] = beta1_pow_t
         return updates
 
-    def reset(self):
-        for param in self.params:
-            param.set_value(param.get_value() * np.float32(0))
-
 
 class NAdam(Optimizer):
     def __init__(self, alpha=1e-3, beta1=.99, beta2=.999, epsilon=1e-8,
                  decay=lambda x, t: x * (1. - .5 * .96 ** (t / 250.)), **kwargs):
         super(NAdam, self).__init__(alpha, **kwargs)
-        self.beta1 = T.cast(beta1, theano.config.floatX)
-        self.beta2 = T.cast(beta2, theano.config.floatX)
-        self.epsilon = T.cast(epsilon, theano.config.floatX)
+        self.beta1 = _hyperparameter(beta1, 'beta1', self.freeze_hyperparams)
+        self.beta2 = _hyperparameter(beta2, 'beta2', self.freeze_hyperparams)
+        self.epsilon = _hyperparameter(epsilon, 'epsilon', self.freeze_hyperparams)
         self.decay = decay
         self.descriptions = 'NESTEROV ADAM. ETA = {} BETA1 = {} BETA2 = {}'.format(alpha, beta1, beta2)
         print('Using %s' % self)
@@ -355,87 +593,165 @@ class NAdam(Optimizer):
     def get_updates(self, params, grads):
         updates = OrderedDict()
 
-        beta1_acc = theano.shared(np.float32(1.), 'beta1 accumulation')
-        t_prev = theano.shared(np.float32(0), 'time')
-        self.params += [beta1_acc, t_prev]
+        beta1_acc = theano.shared(np.asarray(1., theano.config.floatX), 'beta1 accumulation')
+        beta2_pow = theano.shared(np.asarray(1., theano.config.floatX), 'beta2_pow')
+        t_prev = theano.shared(np.asarray(0, theano.config.floatX), 'time')
+        self.params.append(t_prev)
+        self.powers += [beta1_acc, beta2_pow]
 
         t = t_prev + 1.
-        for param, g_t in zip(params, grads):
-            value = param.get_value(borrow=True)
-            m_prev = theano.shared(np.zeros_like(value), param.name + '_grad_mva', broadcastable=param.broadcastable)
-            n_prev = theano.shared(np.zeros_like(value), param.name + '_grad_sqr_mva',
-                                   broadcastable=param.broadcastable)
-            self.params += [m_prev, n_prev]
-
-            beta1_t = self.decay(self.beta1, t)
-            beta1_tp1 = self.decay(self.beta1, t + 1.)
-            beta1_acc_t = beta1_acc * beta1_t
-
+        beta1_t = self.decay(self.beta1, t)
+        beta1_tp1 = self.decay(self.beta1, t + 1.)
+        beta1_acc_t = beta1_acc * beta1_t
+        beta2_pow_t = beta2_pow * self.beta2
+        one_minus_beta1 = 1. - self.beta1
+        one_minus_beta2 = 1. - self.beta2
+        m, m_views = _flat_zeros(params, 'grad_mva')
+        n, n_views = _flat_zeros(params, 'grad_sqr_mva')
+        self.params += [m, n]
+
+        ms_t, ns_t = [], []
+        for param, g_t, m_i, n_i in zip(params, grads, m_views, n_views):
             g_hat_t = g_t / (1. - beta1_acc_t)
-            m_t = self.beta1 * m_prev + (1. - self.beta1) * g_t
+            m_t = self.beta1 * m_i + one_minus_beta1 * g_t
             m_hat_t = m_t / (1. - beta1_acc_t * beta1_tp1)
-            n_t = self.beta2 * n_prev + (1 - self.beta2) * g_t ** 2.
-            n_hat_t = n_t / (1. - self.beta2 ** t)
-            m_bar_t = (1. - self.beta1) * g_hat_t + beta1_tp1 * m_hat_t
-
-            updates[param] = param - self.alpha * m_bar_t / (T.sqrt(n_hat_t) + self.epsilon)
-            updates[beta1_acc] = beta1_acc_t
-            updates[m_prev] = m_t
-            updates[n_prev] = n_t
-
+            n_t = self.beta2 * n_i + one_minus_beta2 * T.sqr(g_t)
+            n_hat_t = n_t / (1. - beta2_pow_t)
+            m_bar_t = one_minus_beta1 * g_hat_t + beta1_tp1 * m_hat_t
+            updates[param] = T.cast(param - self.alpha * m_bar_t / (T.sqrt(n_hat_t) + self.epsilon), param.dtype)
+            ms_t.append(m_t)
+            ns_t.append(n_t)
+        updates[m] = _flat_update(m, params, ms_t)
+        updates[n] = _flat_update(n, params, ns_t)
+        updates[beta1_acc] = beta1_acc_t
+        updates[beta2_pow] = beta2_pow_t
         updates[t_prev] = t
         return updates
 
-    def reset(self):
-        for param in self.params:
-            param.set_value(param.get_value() * np.float32(0))
-
 
 class AMSGrad(Optimizer):
-    def __init__(self, alpha=1e-3, beta1=.9, beta2=.99, epsilon=1e-8, decay=lambda x, t: x, **kwargs):
+    numba_kernel = 'amsgrad_step'
+    num_host_states = 3
+
+    def __init__(self, alpha=1e-3, beta1=.9, beta2=.99, epsilon=1e-8, decay=lambda x, t: x,
+                 state_dtype=theano.config.floatX, **kwargs):
         super(AMSGrad, self).__init__(alpha, **kwargs)
-        self.beta1 = T.cast(beta1, theano.config.floatX)
-        self.beta2 = T.cast(beta2, theano.config.floatX)
-        self.epsilon = T.cast(epsilon, theano.config.floatX)
+        self.beta1 = _hyperparameter(beta1, 'beta1', self.freeze_hyperparams)
+        self.beta2 = _hyperparameter(beta2, 'beta2', self.freeze_hyperparams)
+        self.epsilon = _hyperparameter(epsilon, 'epsilon', self.freeze_hyperparams)
         self.decay = decay
+        self.state_dtype = state_dtype
+        self.host_hyperparams = (self.alpha, self.beta1, self.beta2, self.epsilon)
         self.descriptions = 'AMSGRAD. ALPHA = {} BETA1 = {} BETA2 = {}'.format(alpha, beta1, beta2)
         print('Using %s' % self)
 
     def get_updates(self, params, grads):
         updates = OrderedDict()
 
-        t_prev = theano.shared(np.float32(0.), 'time step')
+        t_prev = theano.shared(np.asarray(0., theano.config.floatX), 'time step')
+        beta1_pow = theano.shared(np.asarray(1., theano.config.floatX), 'beta1_pow')
+        beta2_pow = theano.shared(np.asarray(1., theano.config.floatX), 'beta2_pow')
         self.params.append(t_prev)
+        self.powers += [beta1_pow, beta2_pow]
 
         t = t_prev + 1.
         eta_t = self.decay(self.alpha, t)
-        a_t = eta_t * T.sqrt(T.constant(1.) - self.beta2 ** t) / (T.constant(1.) - self.beta1 ** t)
-        for param, g_t in zip(params, grads):
-            value = param.get_value(borrow=True)
-            m_prev = theano.shared(np.zeros_like(value), param.name + '_grad_mva', broadcastable=param.broadcastable)
-            v_prev = theano.shared(np.zeros_like(value), param.name + '_grad_sqr_mva',
-                                   broadcastable=param.broadcastable)
-            v_hat_prev = theano.shared(np.zeros_like(value), param.name + '_grad_sqr_velo',
-                                       broadcastable=param.broadcastable)
-            self.params += [m_prev, v_prev, v_hat_prev]
-
-            m_t = self.beta1 * m_prev + (1. - self.beta1) * g_t
-            v_t = self.beta2 * v_prev + (1. - self.beta2) * g_t ** 2
-            v_hat_t = T.maximum(v_hat_prev, v_t)
-
-            updates[param] = param - a_t * m_t / (T.sqrt(v_hat_t) + self.epsilon)
-            updates[m_prev] = m_t
-            updates[v_prev] = v_t
-            updates[v_hat_prev] = v_hat_t
-
+        beta1_pow_t = beta1_pow * self.beta1
+        beta2_pow_t = beta2_pow * self.beta2
+        a_t = eta_t * T.sqrt(T.constant(1.) - beta2_pow_t) / (T.constant(1.) - beta1_pow_t)
+        m, m_views = _flat_zeros(params, 'grad_mva')
+        v, v_views = _flat_zeros(params, 'grad_sqr_mva', self.state_dtype)
+        v_hat, v_hat_views = _flat_zeros(params, 'grad_sqr_velo', self.state_dtype)
+        self.params += [m, v, v_hat]
+
+        step = _fused_step(_amsgrad_body, 9)
+        floatX = theano.config.floatX
+        ms_t, vs_t, v_hats_t = [], [], []
+        for param, grad, m_i, v_i, v_hat_i in zip(params, grads, m_views, v_views, v_hat_views):
+            param_t, m_t, v_t, v_hat_t = step(T.cast(param, floatX), T.cast(grad, floatX), m_i, T.cast(v_i, floatX),
+                                              T.cast(v_hat_i, floatX), T.cast(a_t, floatX), self.beta1, self.beta2,
+                                              self.epsilon)
+            updates[param] = T.cast(param_t, param.dtype)
+            ms_t.append(m_t)
+            vs_t.append(v_t)
+            v_hats_t.append(v_hat_t)
+        updates[m] = _flat_update(m, params, ms_t)
+        updates[v] = _flat_update(v, params, vs_t)
+        updates[v_hat] = _flat_update(v_hat, params, v_hats_t)
+        updates[beta1_pow] = beta1_pow_t
+        updates[beta2_pow] = beta2_pow_t
         updates[t_prev] = t
         return updates
 
-    def reset(self):
-        for param in self.params:
-            param.set_value(param.get_value() * np.float32(0))
+    def host_args(self, t):
+        alpha, beta1, beta2, epsilon = super(AMSGrad, self).host_args(t)
+        a_t = self.decay(alpha, t) * np.sqrt(1. - beta2 ** t) / (1. - beta1 ** t)
+        return a_t, beta1, beta2, epsilon
+
+
+class _StepCache(dict):
+    # never pickled along with the graph, e.g. when a compiled function is saved
+    def __reduce__(self):
+        return _StepCache, ()
+
+
+# costs that currently hold a step cache, so that clear_step_cache can reach all of them
+_cached_costs = weakref.WeakSet()
+
+
+def _step_cache(cost):
+    """
+    Returns the cache of the optimization steps built for `cost`.
+    The cache is stored in the tag of `cost`, so it is freed together with the cost graph.
+    """
+    cache = getattr(cost.tag, 'step_cache', None)
+    if cache is None:
+        cache = cost.tag.step_cache = _StepCache()
+        _cached_costs.add(cost)
+    return cache
+
+
+def clear_step_cache(cost=None):
+    """
+    Drops cached update graphs and step functions, so that the next call builds them again with fresh optimizer
+    states, e.g. when a new run starts from re-initialized weights.
+
+    :param cost: if given, only the steps built for this cost are dropped. Otherwise every cache is cleared
+    """
+    for cost_ in ([cost] if cost is not None else list(_cached_costs)):
+        if getattr(cost_.tag, 'step_cache', None) is not None:
+            del cost_.tag.step_cache
+        _cached_costs.discard(cost_)
+
+
+def _memoize_step(func):
+    """
+    Caches the output of an optimizer helper on the identity of the parameters and the hyperparameters, per cost,
+    so building the same training step twice does not redo the gradient and update graphs.
+    A cached result shares its optimizer states, which are reset with the returned optimizer's `reset` or dropped
+    with :func:`clear_step_cache`. Every call returns fresh copies of the updates and the list of gradients.
+    """
 
+    @functools.wraps(func)
+    def func_wrapper(cost, params, *args, **kwargs):
+        key = (func.__name__, tuple(id(param) for param in params), args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return func(cost, params, *args, **kwargs)
 
+        cache = _step_cache(cost)
+        if key not in cache:
+            # params are kept with the result so that their ids cannot be reused while the entry exists
+            cache[key] = (params, func(cost, params, *args, **kwargs))
+        # callers often extend the updates, e.g. with batchnorm updates, so they never get the cached containers
+        updates, op, grads = cache[key][-1]
+        return OrderedDict(updates), op, list(grads)
+
+    return func_wrapper
+
+
+@_memoize_step
 def sgd(cost, params, lr=1e-3, clip_by_norm=False, **kwargs):
     grads = T.grad(cost, params)
     if clip_by_norm:
@@ -444,6 +760,7 @@ def sgd(cost, params, lr=1e-3, clip_by_norm=False, **kwargs):
     return sgd_op(params, grads), sgd_op, grads
 
 
+@_memoize_step
 def adadelta(cost, params, mom=.95, epsilon=1e-6, clip_by_norm=False, **kwargs):
     grads = T.grad(cost, params)
     if clip_by_norm:
@@ -452,23 +769,27 @@ def adadelta(cost, params, mom=.95, epsilon=1e-6, clip_by_norm=False, **kwargs):
     return adadelta_op(params, grads), adadelta_op, grads
 
 
-def adam(cost, params, lr=1e-3, beta1=.9, beta2=.999, epsilon=1e-8, clip_by_norm=False, **kwargs):
+@_memoize_step
+def adam(cost, params, lr=1e-3, beta1=.9, beta2=.999, epsilon=1e-8, clip_by_norm=False,
+         state_dtype=theano.config.floatX, **kwargs):
     grads = T.grad(cost, params)
     if clip_by_norm:
         grads = total_norm_constraint(grads, clip_by_norm)
-    adam_op = Adam(lr, beta1, beta2, epsilon)
+    adam_op = Adam(lr, beta1, beta2, epsilon, state_dtype)
     return adam_op(params, grads), adam_op, grads
 
 
+@_memoize_step
 def amsgrad(cost, params, lr=1e-3, beta1=.9, beta2=.999, epsilon=1e-8, decay=lambda x, t: x, clip_by_norm=False,
-            **kwargs):
+            state_dtype=theano.config.floatX, **kwargs):
     grads = T.grad(cost, params)
     if clip_by_norm:
         grads = total_norm_constraint(grads, clip_by_norm)
-    amsgrad_op = AMSGrad(lr, beta1, beta2, epsilon, decay)
+    amsgrad_op = AMSGrad(lr, beta1, beta2, epsilon, decay, state_dtype)
     return amsgrad_op(params, grads), amsgrad_op, grads
 
 
+@_memoize_step
 def sgdmomentum(cost, params, lr, mom=.95, nesterov=False, clip_by_norm=False, **kwargs):
     grads = T.grad(cost, params)
     if clip_by_norm:
@@ -477,6 +798,7 @@ def sgdmomentum(cost, params, lr, mom=.95, nesterov=False, clip_by_norm=False, *
     return sgdmom_op(params, grads), sgdmom_op, grads
 
 
+@_memoize_step
 def rmsprop(cost, params, lr=1e-3, mom=.9, epsilon=1e-6, clip_by_norm=False, **kwargs):
     grads = T.grad(cost, params)
     if clip_by_norm:
@@ -485,6 +807,7 @@ def rmsprop(cost, params, lr=1e-3, mom=.9, epsilon=1e-6, clip_by_norm=False, **k
     return rmsprop_op(params, grads), rmsprop_op, grads
 
 
+@_memoize_step
 def adagrad(cost, params, lr, epsilon=1e-6, clip_by_norm=False, **kwargs):
     grads = T.grad(cost, params)
     if clip_by_norm:
@@ -493,6 +816,7 @@ def adagrad(cost, params, lr, epsilon=1e-6, clip_by_norm=False, **kwargs):
     return adagrad_op(params, grads), adagrad_op, grads
 
 
+@_memoize_step
 def nadam(cost, params, lr=1e-3, beta1=.9, beta2=.999, epsilon=1e-8, decay=lambda x, t: x, clip_by_norm=False,
           **kwargs):
     grads = T.grad(cost, params)
@@ -502,6 +826,7 @@ def nadam(cost, params, lr=1e-3, beta1=.9, beta2=.999, epsilon=1e-8, decay=lambd
     return nadam_op(params, grads), nadam_op, grads
 
 
+@_memoize_step
 def adamax(cost, params, lr=1e-3, beta1=.9, beta2=.999, epsilon=1e-8, clip_by_norm=False, **kwargs):
     grads = T.grad(cost, params)
     if clip_by_norm:
@@ -510,46 +835,113 @@ def adamax(cost, params, lr=1e-3, beta1=.9, beta2=.999, epsilon=1e-8, clip_by_no
     return adamax_op(params, grads), adamax_op, grads
 
 
-def anneal_learning_rate(lr, t, method='half-life', **kwargs):
-    if not isinstance(lr, (T.sharedvar.ScalarSharedVariable, T.sharedvar.TensorSharedVariable)):
-        raise TypeError('lr must be a shared variable, got %s.' % type(lr))
+def step_function(cost, params, inputs, method='adam', **kwargs):
+    """
+    Compiles a Theano function performing one optimization step and returning the cost.
+    The compiled function is cached with the cost, so repeated calls with the same graph skip graph optimization and
+    compilation. Use :func:`clear_step_cache` to build it again with fresh optimizer states.
+
+    :param cost: a scalar cost to minimize
+    :param params: a list of shared variables to optimize
+    :param inputs: a list of symbolic inputs of the cost
+    :param method: name of the optimizer. See `optimizer`
+    :param kwargs: hyperparameters passed to the optimizer
+    :return: the compiled step function and the optimizer op
+    """
 
-    lr_ = lr.get_value()
+    def _compile():
+        # the update graph is only needed for compilation, so it bypasses the cache of the optimizer helpers
+        updates, op, _ = optimizer[method].__wrapped__(cost, params, **kwargs)
+        mode = theano.compile.get_default_mode().including('inplace')
+        func = theano.function(inputs, cost, mode=mode, updates=updates, allow_input_downcast=True,
+                               on_unused_input='ignore')
+        return func, op
+
+    key = ('step_function', method, tuple(id(param) for param in params), tuple(id(input) for input in inputs),
+           tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return _compile()
+
+    cache = _step_cache(cost)
+    if key not in cache:
+        cache[key] = (params, inputs, _compile())
+    return cache[key][-1]
+
+
+def _anneal(lr, t, method, exp, **kwargs):
+    """
+    Closed form of the learning rate schedules.
+
+    :param lr: initial learning rate
+    :param t: iteration index, either a numpy array or a Theano tensor
+    :param method: name of the schedule
+    :param exp: exponential function matching the type of `t`
+    :return: the learning rate at `t`
+    """
     if method == 'half-life':
         num_iters = kwargs.pop('num_iters', None)
         decay = kwargs.pop('decay', .1)
         if num_iters is None:
             raise ValueError('num_iters must be provided.')
 
-        cond = T.cast(T.or_(T.eq(t, num_iters // 2), T.eq(t, 3 * num_iters // 4)), theano.config.floatX)
-        lr.default_update = lr * decay * cond + (1. - cond) * lr
+        num_decays = (t >= num_iters // 2).astype('int32') + (t >= 3 * num_iters // 4).astype('int32')
+        return lr * decay ** num_decays
     elif method == 'step':
         step = kwargs.pop('step', None)
         decay = kwargs.pop('decay', .5)
         if step is None:
             raise ValueError('step must be provided.')
 
-        cond = T.cast(T.eq(T.mod(t, step), 0), theano.config.floatX)
-        lr.default_update = lr * decay * cond + (1. - cond) * lr
+        return lr * decay ** (t // step)
     elif method == 'exponential':
         decay = kwargs.pop('decay', 1e-4)
-        t = T.cast(t, theano.config.floatX)
-        lr.default_update = lr_ * T.exp(-decay * t)
+        return lr * exp(-decay * t)
     elif method == 'linear':
         num_iters = kwargs.pop('num_iters', None)
         if num_iters is None:
             raise ValueError('num_iters must be provided.')
 
-        t = T.cast(t, theano.config.floatX)
-        lr.default_update = lr_ * (1. - t / np.cast[theano.config.floatX](num_iters))
+        return lr * (1. - t / np.cast[theano.config.floatX](num_iters))
     elif method == 'inverse':
         decay = kwargs.pop('decay', .01)
-        t = T.cast(t, theano.config.floatX)
-        lr.default_update = lr_ / (1. + decay * t)
+        return lr / (1. + decay * t)
     else:
         raise ValueError('Unknown annealing method.')
 
 
+def anneal_learning_rate(lr, t, method='half-life', **kwargs):
+    if not isinstance(lr, (T.sharedvar.ScalarSharedVariable, T.sharedvar.TensorSharedVariable)):
+        raise TypeError('lr must be a shared variable, got %s.' % type(lr))
+
+    lr_ = lr.get_value()
+    t = T.cast(t, theano.config.floatX)
+    lr.default_update = T.cast(_anneal(lr_, t, method, T.exp, **kwargs), lr.dtype)
+
+
+class LRSchedule:
+    """
+    Precomputes a learning rate schedule for `num_iters` iterations so that annealing is a single table lookup.
+    The methods and keyword arguments are the same as in `anneal_learning_rate`.
+    """
+
+    def __init__(self, lr, num_iters, method='half-life', **kwargs):
+        t = np.arange(num_iters + 1, dtype=theano.config.floatX)
+        kwargs['num_iters'] = num_iters
+        self.table = np.asarray(_anneal(lr, t, method, np.exp, **kwargs), theano.config.floatX)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, t):
+        return self.table[t]
+
+    def anneal(self, lr, t):
+        """Sets the shared variable `lr` to the learning rate at iteration `t`."""
+        lr.set_value(self.table[t])
+
+
 def norm_constraint(tensor_var, max_norm, norm_axes=None, epsilon=1e-7):
     """Max weight norm constraints and gradient clipping
     This takes a TensorVariable and rescales it so that incoming weight
@@ -0,0 +1,135 @@
+'''
+Custom gpuarray kernels for the optimizers in optimization.py.
+Each Op performs the whole update of a flat parameter vector and its flat state vectors in a single launch.
+Requires pygpu and a CUDA device.
+'''
+
+from pygpu import gpuarray
+from theano import tensor as T
+from theano.gof import Apply, Op
+from theano.gpuarray.basic_ops import GpuKernelBase, Kernel, as_gpuarray_variable, gpu_contiguous, infer_context_name
+from theano.gpuarray.type import gpu_context_type
+
+__all__ = ['GpuAdamStep', 'gpu_adam_step']
+
+ADAM_KERNEL = """#include "cluda.h"
+
+KERNEL void adam_step(GLOBAL_MEM const float *p, ga_size p_off, GLOBAL_MEM const float *g, ga_size g_off,
+                      GLOBAL_MEM const float *m, ga_size m_off, GLOBAL_MEM const float *v, ga_size v_off,
+                      GLOBAL_MEM float *p_t, ga_size p_t_off, GLOBAL_MEM float *m_t, ga_size m_t_off,
+                      GLOBAL_MEM float *v_t, ga_size v_t_off,
+                      float a_t, float beta1, float beta2, float epsilon, ga_size n) {
+    p = (GLOBAL_MEM const float *)(((GLOBAL_MEM const char *)p) + p_off);
+    g = (GLOBAL_MEM const float *)(((GLOBAL_MEM const char *)g) + g_off);
+    m = (GLOBAL_MEM const float *)(((GLOBAL_MEM const char *)m) + m_off);
+    v = (GLOBAL_MEM const float *)(((GLOBAL_MEM const char *)v) + v_off);
+    p_t = (GLOBAL_MEM float *)(((GLOBAL_MEM char *)p_t) + p_t_off);
+    m_t = (GLOBAL_MEM float *)(((GLOBAL_MEM char *)m_t) + m_t_off);
+    v_t = (GLOBAL_MEM float *)(((GLOBAL_MEM char *)v_t) + v_t_off);
+    for (ga_size i = GID_0 * LDIM_0 + LID_0; i < n; i += GDIM_0 * LDIM_0) {
+        float gi = g[i];
+        float mi = beta1 * m[i] + (1.f - beta1) * gi;
+        float vi = beta2 * v[i] + (1.f - beta2) * gi * gi;
+        m_t[i] = mi;
+        v_t[i] = vi;
+        p_t[i] = p[i] - a_t * mi / (sqrt(vi) + epsilon);
+    }
+}
+"""
+
+
+class GpuAdamStep(GpuKernelBase, Op):
+    """
+    Fused Adam update of flat float32 vectors living on the GPU.
+    Returns the new parameter vector and the new first and second moments.
+    """
+    __props__ = ()
+    params_type = gpu_context_type
+
+    def make_node(self, param, grad, m, v, a_t, beta1, beta2, epsilon):
+        ctx_name = infer_context_name(param, grad, m, v)
+        vectors = [gpu_contiguous(as_gpuarray_variable(x, ctx_name)) for x in (param, grad, m, v)]
+        for x in vectors:
+            if x.ndim != 1 or x.dtype != 'float32':
+                raise TypeError('GpuAdamStep only supports flat float32 vectors, got %s.' % x.type)
+
+        scalars = [T.cast(T.as_tensor_variable(x), 'float32') for x in (a_t, beta1, beta2, epsilon)]
+        return Apply(self, vectors + scalars, [vectors[0].type(), vectors[2].type(), vectors[3].type()])
+
+    def get_params(self, node):
+        return node.inputs[0].type.context
+
+    def infer_shape(self, node, shapes):
+        return [shapes[0], shapes[2], shapes[3]]
+
+    def gpu_kernels(self, node, name):
+        params = [gpuarray.GpuArray, gpuarray.SIZE] * 7 + ['float32'] * 4 + [gpuarray.SIZE]
+        return [Kernel(code=ADAM_KERNEL, name='adam_step', params=params, flags=Kernel.get_flags('float32'),
+                       objvar='k_adam_step_' + name)]
+
+    def c_code(self, node, name, inp, out, sub):
+        p, g, m, v, a_t, beta1, beta2, epsilon = inp
+        p_t, m_t, v_t = out
+        fail = sub['fail']
+        ctx = sub['params']
+        kname = self.gpu_kernels(node, name)[0].objvar
+        return """
+        size_t n = PyGpuArray_SIZE(%(p)s);
+        size_t ls = 256, gs;
+        int err;
+
+        if (PyGpuArray_SIZE(%(g)s) != n || PyGpuArray_SIZE(%(m)s) != n || PyGpuArray_SIZE(%(v)s) != n) {
+            PyErr_SetString(PyExc_ValueError, "GpuAdamStep: inputs must have the same size.");
+            %(fail)s
+        }
+
+        Py_XDECREF(%(p_t)s);
+        %(p_t)s = pygpu_empty(1, PyGpuArray_DIMS(%(p)s), GA_FLOAT, GA_C_ORDER, %(ctx)s, Py_None);
+        Py_XDECREF(%(m_t)s);
+        %(m_t)s = pygpu_empty(1, PyGpuArray_DIMS(%(m)s), GA_FLOAT, GA_C_ORDER, %(ctx)s, Py_None);
+        Py_XDECREF(%(v_t)s);
+        %(v_t)s = pygpu_empty(1, PyGpuArray_DIMS(%(v)s), GA_FLOAT, GA_C_ORDER, %(ctx)s, Py_None);
+        if (%(p_t)s == NULL || %(m_t)s == NULL || %(v_t)s == NULL) {
+            %(fail)s
+        }
+
+        if (n > 0) {
+            gs = (n + ls - 1) / ls;
+            if (gs > 4096)
+                gs = 4096;
+            err = adam_step_call(1, &gs, &ls, 0,
+                                 %(p)s->ga.data, %(p)s->ga.offset, %(g)s->ga.data, %(g)s->ga.offset,
+                                 %(m)s->ga.data, %(m)s->ga.offset, %(v)s->ga.data, %(v)s->ga.offset,
+                                 %(p_t)s->ga.data, %(p_t)s->ga.offset, %(m_t)s->ga.data, %(m_t)s->ga.offset,
+                                 %(v_t)s->ga.data, %(v_t)s->ga.offset,
+                                 ((dtype_%(a_t)s *)PyArray_DATA(%(a_t)s))[0],
+                                 ((dtype_%(beta1)s *)PyArray_DATA(%(beta1)s))[0],
+                                 ((dtype_%(beta2)s *)PyArray_DATA(%(beta2)s))[0],
+                                 ((dtype_%(epsilon)s *)PyArray_DATA(%(epsilon)s))[0],
+                                 n);
+            if (err != GA_NO_ERROR) {
+                PyErr_Format(PyExc_RuntimeError, "gpuarray error: adam_step: %%s.", GpuKernel_error(&%(kname)s, err));
+                %(fail)s
+            }
+        }
+        """ % locals()
+
+    def c_code_cache_version(self):
+        return (1,)
+
+
+def gpu_adam_step(param, grad, m, v, a_t, beta1, beta2, epsilon):
+    """
+    Symbolic Adam step on flat float32 vectors computed by :class:`GpuAdamStep`.
+
+    :param param: flat parameter vector
+    :param grad: flat gradient vector
+    :param m: flat first moment
+    :param v: flat second moment
+    :param a_t: bias-corrected learning rate
+    :param beta1: decay rate of the first moment
+    :param beta2: decay rate of the second moment
+    :param epsilon: numerical constant
+    :return: the new parameter vector, first moment and second moment
+    """
+    return GpuAdamStep()(param, grad, m, v, a_t, beta1, beta2, epsilon)
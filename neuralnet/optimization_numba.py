@@ -0,0 +1,51 @@
+'''
+Numba kernels for the host-side update of the optimizers in optimization.py.
+Each kernel updates a flat parameter vector and its flat state vectors in place.
+Requires Numba.
+'''
+
+import math
+
+from numba import njit, prange
+
+__all__ = ['adam_step', 'amsgrad_step', 'rmsprop_step', 'adadelta_step', 'adagrad_step']
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def adam_step(param, grad, m, v, a_t, beta1, beta2, epsilon):
+    for i in prange(param.size):
+        m[i] = beta1 * m[i] + (1. - beta1) * grad[i]
+        v[i] = beta2 * v[i] + (1. - beta2) * grad[i] * grad[i]
+        param[i] -= a_t * m[i] / (math.sqrt(v[i]) + epsilon)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def amsgrad_step(param, grad, m, v, v_hat, a_t, beta1, beta2, epsilon):
+    for i in prange(param.size):
+        m[i] = beta1 * m[i] + (1. - beta1) * grad[i]
+        v[i] = beta2 * v[i] + (1. - beta2) * grad[i] * grad[i]
+        v_hat[i] = max(v_hat[i], v[i])
+        param[i] -= a_t * m[i] / (math.sqrt(v_hat[i]) + epsilon)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def rmsprop_step(param, grad, grad2, alpha, gamma, epsilon):
+    for i in prange(param.size):
+        grad2[i] = gamma * grad2[i] + (1. - gamma) * grad[i] * grad[i]
+        param[i] -= alpha * grad[i] / math.sqrt(grad2[i] + epsilon)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def adadelta_step(param, grad, Eg2, Edelx2, rho, epsilon):
+    for i in prange(param.size):
+        Eg2[i] = rho * Eg2[i] + (1. - rho) * grad[i] * grad[i]
+        delta = math.sqrt((Edelx2[i] + epsilon) / (Eg2[i] + epsilon)) * grad[i]
+        param[i] -= delta
+        Edelx2[i] = rho * Edelx2[i] + (1. - rho) * delta * delta
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def adagrad_step(param, grad, grad2, alpha, epsilon):
+    for i in prange(param.size):
+        grad2[i] += grad[i] * grad[i]
+        param[i] -= alpha * grad[i] / math.sqrt(grad2[i] + epsilon)
@@ -339,6 +339,216 @@ def test_lr_annealing():
         utt.assert_allclose(vals_th, vals_np)
 
 
+def test_lr_schedule():
+    base_lr = 1.
+    n_iters = 50
+    decay = 1e-2
+    step = 10
+
+    idx = T.scalar('it', 'int32')
+    for method in ('linear', 'step', 'exponential', 'inverse', 'half-life'):
+        print('Testing method %s' % method)
+        lr_ = nn.placeholder(dtype=theano.config.floatX, value=base_lr, name='lr')
+        y = 0. + lr_
+        nn.anneal_learning_rate(lr_, idx, method, num_iters=n_iters, decay=decay, step=step)
+        func = nn.function([idx], y)
+        schedule = nn.LRSchedule(base_lr, n_iters, method, decay=decay, step=step)
+        lr_np = nn.placeholder(dtype=theano.config.floatX, value=base_lr, name='lr_np')
+        vals_th, vals_np = [], []
+        for it in range(n_iters):
+            func(it + 1)
+            vals_th.append(lr_.get_value())
+            schedule.anneal(lr_np, it + 1)
+            vals_np.append(lr_np.get_value())
+        utt.assert_allclose(vals_th, vals_np)
+
+
+def _optimizer_engines():
+    try:
+        import numba
+    except ImportError:
+        return 'theano',
+    return 'theano', 'numba'
+
+
+def _run_optimizer(op, param_np, grads_np, engine):
+    param = nn.placeholder(value=param_np, name='param')
+    if engine == 'theano':
+        grad = T.matrix('grad')
+        func = theano.function([grad], updates=op([param], [grad]))
+        for g in grads_np:
+            func(g)
+    else:
+        for g in grads_np:
+            op.apply([param], [g])
+    return param.get_value()
+
+
+_param_np = np.array([[.5, -1.], [2., -.3]], theano.config.floatX)
+_grads_np = [np.array([[.1, -.2], [.3, .4]], theano.config.floatX),
+             np.array([[-.5, .2], [.1, -.3]], theano.config.floatX)]
+
+
+def test_sgd_momentum():
+    lr, mom = .1, .9
+    for nesterov in (False, True):
+        w, v = _param_np.copy(), np.zeros_like(_param_np)
+        for g in _grads_np:
+            v = mom * v - lr * g
+            w += mom * v - lr * g if nesterov else v
+        op = nn.optimization.SGDMomentum(lr, mom, nesterov)
+        utt.assert_allclose(_run_optimizer(op, _param_np, _grads_np, 'theano'), w)
+
+
+def test_adagrad():
+    lr, epsilon = .1, 1e-6
+    w, acc = _param_np.copy(), np.zeros_like(_param_np)
+    for g in _grads_np:
+        acc += g ** 2
+        w -= lr * g / np.sqrt(acc + epsilon)
+
+    for engine in _optimizer_engines():
+        op = nn.optimization.AdaGrad(lr, epsilon, engine=engine)
+        utt.assert_allclose(_run_optimizer(op, _param_np, _grads_np, engine), w)
+
+
+def test_rmsprop():
+    lr, gamma, epsilon = .1, .9, 1e-6
+    w, grad2 = _param_np.copy(), np.zeros_like(_param_np)
+    for g in _grads_np:
+        grad2 = gamma * grad2 + (1. - gamma) * g ** 2
+        w -= lr * g / np.sqrt(grad2 + epsilon)
+
+    for engine in _optimizer_engines():
+        op = nn.optimization.RMSprop(lr, gamma, epsilon, engine=engine)
+        utt.assert_allclose(_run_optimizer(op, _param_np, _grads_np, engine), w)
+
+
+def test_adadelta():
+    rho, epsilon = .95, 1e-6
+    w, Eg2, Edelx2 = _param_np.copy(), np.zeros_like(_param_np), np.zeros_like(_param_np)
+    for g in _grads_np:
+        Eg2 = rho * Eg2 + (1. - rho) * g ** 2
+        delta = np.sqrt((Edelx2 + epsilon) / (Eg2 + epsilon)) * g
+        w -= delta
+        Edelx2 = rho * Edelx2 + (1. - rho) * delta ** 2
+
+    for engine in _optimizer_engines():
+        op = nn.optimization.AdaDelta(rho, epsilon, engine=engine)
+        utt.assert_allclose(_run_optimizer(op, _param_np, _grads_np, engine), w)
+
+
+def test_adam():
+    lr, beta1, beta2, epsilon = .1, .9, .999, 1e-8
+    w, m, v = _param_np.copy(), np.zeros_like(_param_np), np.zeros_like(_param_np)
+    for t, g in enumerate(_grads_np, 1):
+        m = beta1 * m + (1. - beta1) * g
+        v = beta2 * v + (1. - beta2) * g ** 2
+        w -= lr * np.sqrt(1. - beta2 ** t) / (1. - beta1 ** t) * m / (np.sqrt(v) + epsilon)
+
+    for engine in _optimizer_engines():
+        op = nn.optimization.Adam(lr, beta1, beta2, epsilon, engine=engine)
+        utt.assert_allclose(_run_optimizer(op, _param_np, _grads_np, engine), w)
+
+
+def test_adamax():
+    lr, beta1, beta2, epsilon = .1, .9, .999, 1e-8
+    w, m, u = _param_np.copy(), np.zeros_like(_param_np), np.zeros_like(_param_np)
+    for t, g in enumerate(_grads_np, 1):
+        m = beta1 * m + (1. - beta1) * g
+        u = np.maximum(beta2 * u, np.abs(g))
+        w -= lr / (1. - beta1 ** t) * m / (u + epsilon)
+
+    op = nn.optimization.AdaMax(lr, beta1, beta2, epsilon)
+    utt.assert_allclose(_run_optimizer(op, _param_np, _grads_np, 'theano'), w)
+
+
+def test_amsgrad():
+    lr, beta1, beta2, epsilon = .1, .9, .99, 1e-8
+    w, m, v, v_hat = _param_np.copy(), np.zeros_like(_param_np), np.zeros_like(_param_np), np.zeros_like(_param_np)
+    for t, g in enumerate(_grads_np, 1):
+        m = beta1 * m + (1. - beta1) * g
+        v = beta2 * v + (1. - beta2) * g ** 2
+        v_hat = np.maximum(v_hat, v)
+        w -= lr * np.sqrt(1. - beta2 ** t) / (1. - beta1 ** t) * m / (np.sqrt(v_hat) + epsilon)
+
+    for engine in _optimizer_engines():
+        op = nn.optimization.AMSGrad(lr, beta1, beta2, epsilon, engine=engine)
+        utt.assert_allclose(_run_optimizer(op, _param_np, _grads_np, engine), w)
+
+
+def test_nadam():
+    def decay(x, t):
+        return x * (1. - .5 * .96 ** (t / 250.))
+
+    lr, beta1, beta2, epsilon = .1, .99, .999, 1e-8
+    w, m, n, beta1_acc = _param_np.copy(), np.zeros_like(_param_np), np.zeros_like(_param_np), 1.
+    for t, g in enumerate(_grads_np, 1):
+        beta1_tp1 = decay(beta1, t + 1.)
+        beta1_acc *= decay(beta1, t)
+        m = beta1 * m + (1. - beta1) * g
+        n = beta2 * n + (1. - beta2) * g ** 2
+        m_bar = (1. - beta1) * g / (1. - beta1_acc) + beta1_tp1 * m / (1. - beta1_acc * beta1_tp1)
+        w -= lr * m_bar / (np.sqrt(n / (1. - beta2 ** t)) + epsilon)
+
+    op = nn.optimization.NAdam(lr, beta1, beta2, epsilon, decay)
+    utt.assert_allclose(_run_optimizer(op, _param_np, _grads_np, 'theano'), w)
+
+
+def test_optimizer_host_hyperparams():
+    if 'numba' not in _optimizer_engines():
+        return
+
+    lr, epsilon = .1, 1e-6
+    w, acc = _param_np.copy(), np.zeros_like(_param_np)
+    for g, lr_t in zip(_grads_np, (lr, lr / 2.)):
+        acc += g ** 2
+        w -= lr_t * g / np.sqrt(acc + epsilon)
+
+    lr_ = nn.placeholder(dtype=theano.config.floatX, value=lr, name='lr')
+    op = nn.optimization.AdaGrad(lr_, epsilon, engine='numba')
+    param = nn.placeholder(value=_param_np, name='param')
+    op.apply([param], [_grads_np[0]])
+    lr_.set_value(lr / 2.)
+    op.apply([param], [_grads_np[1]])
+    utt.assert_allclose(param.get_value(), w)
+
+
+def test_step_cache():
+    x = T.vector('x')
+    w = nn.placeholder(value=np.ones((3,), theano.config.floatX), name='w')
+    cost = T.sum(T.sqr(w * x))
+
+    updates, op, grads = nn.adam(cost, [w], lr=.1)
+    updates_, op_, grads_ = nn.adam(cost, [w], lr=.1)
+    assert op_ is op and updates_ is not updates and grads_ is not grads
+    assert list(updates_.items()) == list(updates.items()) and grads_ == grads
+    updates_.clear()
+    assert len(nn.adam(cost, [w], lr=.1)[0]) == len(updates)
+    assert nn.adam(cost, [w], lr=.2)[1] is not op
+
+    func, step_op = nn.step_function(cost, [w], [x], 'adam', lr=.1)
+    assert nn.step_function(cost, [w], [x], 'adam', lr=.1) == (func, step_op)
+    func(np.ones((3,), theano.config.floatX))
+    assert np.all(w.get_value() < 1.)
+
+    nn.clear_step_cache(cost)
+    assert nn.adam(cost, [w], lr=.1)[1] is not op
+    assert nn.step_function(cost, [w], [x], 'adam', lr=.1)[0] is not func
+
+    op = nn.adam(cost, [w], lr=.1)[1]
+    nn.clear_step_cache()
+    assert nn.adam(cost, [w], lr=.1)[1] is not op
+
+
+def test_optimizer_state_inplace():
+    params = [nn.placeholder(value=_param_np, name='w'), nn.placeholder(value=_param_np[0], name='b')]
+    grads = [T.matrix('grad_w'), T.vector('grad_b')]
+    func = theano.function(grads, updates=nn.optimization.Adam()(params, grads))
+    writes = [node.op for node in func.maker.fgraph.toposort() if 'IncSubtensor' in type(node.op).__name__]
+    assert writes and all(write.inplace for write in writes)
+
+
 def test_data_manager():
     from scipy import misc
     path = 'test_files'
@@ -391,6 +601,33 @@ def test_data_manager():
     utt.assert_allclose(i + 1, num_iters)
 
 
+def test_prefetch():
+    def failing(n):
+        for i in range(n):
+            yield i
+        raise ValueError('corrupted batch')
+
+    for num_cached in (0, 2, 32):
+        dm = nn.DataManager(batch_size=1, n_epochs=1, num_cached=num_cached)
+        assert list(dm.generate_in_background(iter(range(100)))) == list(range(100))
+
+        items = []
+        try:
+            for item in dm.generate_in_background(failing(10)):
+                items.append(item)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('the error raised by the generator was not propagated')
+        assert items == list(range(10))
+        assert list(dm.generate_in_background(iter(range(5)))) == list(range(5))
+
+        next(dm.generate_in_background(iter(range(100))))
+        dm.close()
+        assert list(dm.generate_in_background(iter(range(5)))) == list(range(5))
+        dm.close()
+
+
 def test_model_zoo_resnet18():
     top = 1
     root = 'test_files/'
@@ -779,6 +1016,184 @@ def test_reflection_padding():
     misc.imsave('test_files/lena_small_ref_padded.jpg', out)
 
 
+def test_padding_matches_np_pad():
+    x = np.random.rand(2, 3, 7, 9).astype(theano.config.floatX)
+    input = T.tensor4('input')
+
+    for padding, widths in ((2, ((2, 2), (2, 2))), ((1, 3, 2, 0), ((2, 0), (1, 3)))):
+        out = nn.utils.replication_pad(input, padding).eval({input: x})
+        utt.assert_allclose(out, np.pad(x, ((0, 0), (0, 0)) + widths, mode='edge'))
+
+    for padding, widths in ((3, ((3, 3), (3, 3))), ((2, 4), ((2, 2), (4, 4))), (((1, 2), (0, 3)), ((1, 2), (0, 3)))):
+        out = nn.utils.reflection_pad(input, padding).eval({input: x})
+        utt.assert_allclose(out, np.pad(x, ((0, 0), (0, 0)) + widths, mode='reflect'))
+
+
+def test_unpool():
+    x = np.random.rand(2, 3, 4, 5).astype(theano.config.floatX)
+    input = T.tensor4('input')
+    for shape in (2, (3, 2)):
+        sh, sw = (shape, shape) if isinstance(shape, int) else shape
+        out = nn.utils.unpool(input, shape).eval({input: x})
+        utt.assert_allclose(out, np.repeat(np.repeat(x, sh, 2), sw, 3))
+
+
+def test_gaussian_kernels():
+    def gaussian2(size, sigma):
+        A = 1. / (2. * np.pi * sigma ** 2)
+        x, y = np.mgrid[-size // 2 + 1:size // 2 + 1, -size // 2 + 1:size // 2 + 1]
+        return np.float32(A * np.exp(-((x ** 2 / (2. * sigma ** 2)) + (y ** 2 / (2. * sigma ** 2)))))
+
+    def laplacian_of_gaussian_kernel(size, sigma):
+        x, y = np.mgrid[-size // 2 + 1:size // 2 + 1, -size // 2 + 1:size // 2 + 1]
+        g = 1 / (2 * np.pi * sigma ** 4) * ((x ** 2 + y ** 2 - 2 * sigma ** 2) / sigma ** 2) * np.exp(
+            -(x ** 2 + y ** 2) / (2 * sigma ** 2))
+        return np.float32(g)
+
+    size_, sigma_ = T.iscalar('size'), T.scalar('sigma')
+    window = nn.utils.fspecial_gauss(size_, sigma_)
+    for size, sigma in ((3, 1.), (8, 1.5), (11, 1.5), (21, 1.6)):
+        utt.assert_allclose(nn.utils.gaussian2(size, sigma), gaussian2(size, sigma))
+        g1 = nn.utils.gaussian1d(size, sigma)
+        utt.assert_allclose(np.outer(g1, g1), gaussian2(size, sigma))
+        utt.assert_allclose(nn.utils.laplacian_of_gaussian_kernel(size, sigma),
+                            laplacian_of_gaussian_kernel(size, sigma))
+
+        g = gaussian2(size, sigma)
+        utt.assert_allclose(nn.utils.fspecial_gauss(size, sigma).eval(), g / np.sum(g))
+        utt.assert_allclose(window.eval({size_: size, sigma_: sigma}), g / np.sum(g))
+
+
+def test_difference_of_gaussian():
+    def difference_of_gaussian(x, size, sigma1, sigma2, depth):
+        outputs = []
+        for sigma in (sigma1, sigma2):
+            kern = np.zeros((depth, depth, size, size), theano.config.floatX)
+            for i in range(depth):
+                kern[i, i] = nn.utils.gaussian2(size, sigma)
+            outputs.append(T.nnet.conv2d(x, kern, border_mode='half'))
+        return outputs[1] - outputs[0]
+
+    x = np.random.rand(2, 3, 32, 32).astype(theano.config.floatX)
+    input = T.tensor4('input')
+    for size in (3, 21):
+        out = nn.utils.difference_of_gaussian(input, size, 1., 1.6, 3)
+        ref = difference_of_gaussian(input, size, 1., 1.6, 3)
+        func = theano.function([input], [out, ref])
+        out, ref = func(x)
+        utt.assert_allclose(out, ref)
+
+
+def test_point_op():
+    import sys
+
+    lut = np.linspace(0., 1., 10).astype(theano.config.floatX) ** 2
+    origin, increment = .1, .1
+    image = np.random.uniform(-.5, 1.5, (6, 7)).astype(theano.config.floatX)
+
+    input = T.matrix('input')
+    ref = nn.utils.point_op(input, T.constant(lut), origin, increment).eval({input: image})
+    utt.assert_allclose(nn.utils.point_op(image, lut, origin, increment), ref)
+
+    # without Numba, numpy inputs take the numpy fallback
+    utils_numba = sys.modules.get('neuralnet.utils_numba')
+    sys.modules['neuralnet.utils_numba'] = None
+    try:
+        utt.assert_allclose(nn.utils.point_op(image, lut, origin, increment), ref)
+    finally:
+        if utils_numba is None:
+            del sys.modules['neuralnet.utils_numba']
+        else:
+            sys.modules['neuralnet.utils_numba'] = utils_numba
+
+
+def test_transform_affine():
+    def transform_affine(theta, im):
+        n, c, h, w = im.shape
+        x_t, y_t = np.meshgrid(np.linspace(-1, 1, w), np.linspace(-1, 1, h))
+        grid = np.vstack([x_t.flatten(), y_t.flatten(), np.ones(h * w)])
+        out = np.zeros_like(im)
+        for i in range(n):
+            xs, ys = np.dot(theta[i].reshape((2, 3)), grid)
+            x, y = (xs + 1) / 2 * (w - 1), (ys + 1) / 2 * (h - 1)
+            x0, y0 = np.floor(x), np.floor(y)
+            dx, dy = x0 + 1 - x, y0 + 1 - y
+            x0_, x1_ = np.clip(x0, 0, w - 1).astype('int64'), np.clip(x0 + 1, 0, w - 1).astype('int64')
+            y0_, y1_ = np.clip(y0, 0, h - 1).astype('int64'), np.clip(y0 + 1, 0, h - 1).astype('int64')
+            out[i] = (dx * dy * im[i][:, y0_, x0_] + dx * (1 - dy) * im[i][:, y1_, x0_] +
+                      (1 - dx) * dy * im[i][:, y0_, x1_] + (1 - dx) * (1 - dy) * im[i][:, y1_, x1_]).reshape((c, h, w))
+        return out
+
+    shape = (2, 3, 5, 6)
+    x = np.random.rand(*shape).astype(theano.config.floatX)
+    theta_np = np.array([[1.1, .1, .05, -.1, .9, -.05], [.8, -.2, .3, .2, 1.2, .1]], theano.config.floatX)
+    input, theta = T.tensor4('input'), T.matrix('theta')
+    ref = transform_affine(theta_np, x)
+    for input_shape in (None, shape):
+        out = nn.utils.transform_affine(theta, input, input_shape=input_shape).eval({theta: theta_np, input: x})
+        utt.assert_allclose(out, ref)
+
+
+def test_convert_dense_weights_data_format():
+    def convert_dense_weights_data_format(weights, previous_feature_map_shape, target_data_format):
+        kernel = np.array(weights, theano.config.floatX)
+        for i in range(kernel.shape[1]):
+            if target_data_format == 'channels_first':
+                c, h, w = previous_feature_map_shape
+                ki = np.transpose(kernel[:, i].reshape((h, w, c)), (2, 0, 1))
+            else:
+                h, w, c = previous_feature_map_shape
+                ki = np.transpose(kernel[:, i].reshape((c, h, w)), (1, 2, 0))
+            kernel[:, i] = np.reshape(ki, (np.prod(previous_feature_map_shape),))
+        return kernel
+
+    weights = np.random.rand(2 * 3 * 4, 5).astype(theano.config.floatX)
+    for shape, data_format in (((2, 3, 4), 'channels_first'), ((3, 4, 2), 'channels_last')):
+        utt.assert_allclose(nn.utils.convert_dense_weights_data_format(weights, shape, data_format),
+                            convert_dense_weights_data_format(weights, shape, data_format))
+
+
+def test_imresize():
+    from PIL import Image
+
+    def imresize(image, size):
+        # scipy.misc.imresize with interp='bilinear': bytescale, then resize with PIL
+        if image.dtype != np.uint8:
+            low, high = image.min(), image.max()
+            scale = 255. / (high - low if high > low else 1.)
+            image = (np.clip((image - low) * scale, 0, 255) + .5).astype(np.uint8)
+        return np.array(Image.fromarray(image).resize((size[1], size[0]), resample=Image.BILINEAR))
+
+    image = np.random.rand(8, 10, 3).astype('float32') * 3. - 1.
+    for im in (image, imresize(image, image.shape[:2])):
+        out = nn.utils.imresize(im, im.shape[:2])
+        assert out.dtype == np.uint8 and np.array_equal(out, imresize(im, im.shape[:2]))
+
+        # upsampling uses the same half-pixel bilinear weights in OpenCV and PIL, up to rounding
+        out = nn.utils.imresize(im, (16, 20))
+        assert out.shape == (16, 20, 3) and out.dtype == np.uint8
+        assert np.abs(out.astype('int64') - imresize(im, (16, 20))).max() <= 1
+
+
+def test_nchwc():
+    block = 4
+    input = T.tensor4('input')
+    blocked = nn.utils.to_nchwc(input, block)
+    func = theano.function([input], [blocked, nn.utils.from_nchwc(blocked)])
+
+    x = np.random.rand(2, 8, 5, 6).astype(theano.config.floatX)
+    blocked_np, x_np = func(x)
+    utt.assert_allclose(blocked_np, np.transpose(np.reshape(x, (2, 2, block, 5, 6)), (0, 1, 3, 4, 2)))
+    utt.assert_allclose(x_np, x)
+
+    try:
+        func(np.random.rand(2, 6, 5, 6).astype(theano.config.floatX))
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError('to_nchwc should reject a number of channels that is not a multiple of block.')
+
+
 def test_spatial_transformer():
     input_shape = (None, 3, 220, 220)
     down_factor = 1
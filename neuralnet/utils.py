@@ -1,17 +1,19 @@
 import abc
+import copy
 import json
 import logging
-import pickle as pkl
+import operator
+import os
 import sys
 import threading
 import time
-from functools import reduce
-from queue import Queue
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, reduce
 
-import cloudpickle as cpkl
 import numpy as np
 import theano
-from scipy import misc
 from theano import tensor as T
 from theano import gradient as G
 from theano.gpuarray.dnn import dnn_pool as pool
@@ -19,7 +21,6 @@ from theano.gpuarray.dnn import dnn_pool as pool
 from neuralnet import __version__
 
 __all__ = ['ConfigParser', 'DataManager', 'placeholder']
-thread_lock = threading.Lock()
 srng = theano.sandbox.rng_mrg.MRG_RandomStreams(np.random.RandomState(int(time.time())).randint(1, int(time.time())))
 
 
@@ -53,6 +54,10 @@ def deprecated(version=None, message=None):
 
 
 class Thread(threading.Thread):
+    """
+    Runs `func` in a separate thread and keeps its return value in `outputs`.
+    `func` is not serialized with other threads, so it must guard any shared state with its own lock.
+    """
     def __init__(self, id, name, func):
         threading.Thread.__init__(self)
         self.id = id
@@ -61,9 +66,14 @@ class Thread(threading.Thread):
 
     def run(self):
         print('Starting ' + self.name)
-        thread_lock.acquire()
         self.outputs = self.func()
-        thread_lock.release()
+
+
+@lru_cache(maxsize=32)
+def _load_json(path, mtime):
+    # mtime is part of the cache key so that edited files are parsed again
+    with open(path) as f:
+        return json.load(f)
 
 
 class ConfigParser:
@@ -77,12 +87,35 @@ class ConfigParser:
 
     def load_configuration(self):
         try:
-            with open(self.config_file) as f:
-                data = json.load(f)
-            print('Config file loaded successfully')
-        except:
-            raise NameError('Unable to open config file!!!')
-        return data
+            data = _load_json(self.config_file, os.path.getmtime(self.config_file))
+        except (OSError, json.JSONDecodeError) as e:
+            raise NameError('Unable to open config file!!!') from e
+        print('Config file loaded successfully')
+        # callers pop entries from the config, so the cached dict must not be handed out
+        return copy.deepcopy(data)
+
+
+_END_OF_BATCHES = object()
+
+
+class _PrefetchError:
+    # handed to the consumer in place of _END_OF_BATCHES when the data generator raises
+    def __init__(self, error):
+        self.error = error
+
+
+def _augment_batch(batch, augmentation, apply_to):
+    if isinstance(batch, np.ndarray):
+        for transform in augmentation:
+            batch = transform(batch)
+        return batch
+
+    assert isinstance(apply_to, list), 'Expect a list of indices to which augmentation is applied. Got %s.' % type(
+        apply_to)
+    for idx in apply_to:
+        for transform in augmentation:
+            batch[idx] = transform(batch[idx])
+    return batch
 
 
 class DataManager(ConfigParser, metaclass=abc.ABCMeta):
@@ -95,6 +128,14 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
         Either a config_file specifying path, batch_size, and n_epochs or these parameters themselvesshould be provided.
         A placeholder of a list (tuple) of placeholders should be provided if gpu is to be used. In that case, the
         returned object when being iterated is the iteration index. Otherwise, a tuple of data shall be returned.
+        If `num_workers` is given in kwargs and is positive, augmentation runs in a pool of that many worker processes,
+        which is kept alive across epochs. The transforms must then be picklable.
+        If `device_prefetch` is True in kwargs, batches for GPU placeholders are uploaded to the device by the background
+        thread, so that `update_input` only swaps device buffers. Run Theano with `gpuarray.single_stream=False` to let
+        the uploads overlap with computation.
+        `num_cached` (default 32) is the number of batches prefetched ahead of the training loop. Deeper prefetching
+        hides slow loading better, but costs about `num_cached * batch_bytes` of host memory, so lower it for large
+        batches. Zero or a negative value makes the cache unbounded.
         :param config_file:
         :param placeholders:
         :param batch_size:
@@ -110,9 +151,11 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
 
         self.path = self.config['data'].get('path') if config_file else kwargs.pop('path', None)
         self.shuffle = self.config['data'].get('shuffle') if config_file else kwargs.pop('shuffle', False)
-        self.num_cached = self.config['data'].get('num_cached') if config_file else kwargs.pop('num_cached', 10)
+        self.num_cached = self.config['data'].get('num_cached') if config_file else kwargs.pop('num_cached', 32)
         self.augmentation = kwargs.pop('augmentation', None)
         self.apply_to = kwargs.pop('apply_to', [0])
+        self.num_workers = kwargs.pop('num_workers', 0)
+        self.device_prefetch = kwargs.pop('device_prefetch', False)
         self.cur_epoch = kwargs.pop('checkpoint', 0)
         self.infinite = kwargs.pop('infinite', False)
         self.kwargs = kwargs
@@ -120,6 +163,37 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
         self.data_size = None
         self.placeholders = placeholders
         self.batches = None
+        self._prefetch_cv = threading.Condition()
+        self._prefetch_buffer = deque()
+        self._prefetch_source = None
+        self._prefetch_thread = None
+        self._prefetch_job = 0
+        self._prefetch_closed = False
+        self._pool = None
+
+    def __del__(self):
+        if getattr(self, '_pool', None) is not None:
+            self._pool.shutdown(wait=False)
+
+    def close(self):
+        """
+        Stops the prefetch thread and shuts down the augmentation worker processes. Batches still queued for
+        augmentation are cancelled. Both are started again if batches are requested afterwards.
+        """
+        with self._prefetch_cv:
+            self._prefetch_closed = True
+            self._prefetch_cv.notify_all()
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+        with self._prefetch_cv:
+            self._prefetch_closed = False
+            self._prefetch_source = None
+            self._prefetch_buffer.clear()
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
 
     @classmethod
     def load_data(self):
@@ -153,19 +227,27 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
             self.augmentation)
         assert all(callable(f) for f in self.augmentation), 'All object in \'augmentation\n should be callable.'
 
-        for batch in minibatches:
-            if isinstance(batch, np.ndarray):
-                for transform in self.augmentation:
-                    batch = transform(batch)
-                yield batch
-            else:
-                assert isinstance(self.apply_to, list), \
-                    'Expect a list of indices to which augmentation is applied. Got %s.' % type(self.apply_to)
+        if not self.num_workers:
+            for batch in minibatches:
+                yield _augment_batch(batch, self.augmentation, self.apply_to)
+            return
 
-                for idx in self.apply_to:
-                    for transform in self.augmentation:
-                        batch[idx] = transform(batch[idx])
-                yield batch
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.num_workers, initializer=np.random.seed)
+
+        # keep up to num_cached batches in flight and yield them in order
+        futures = deque()
+        try:
+            for batch in minibatches:
+                futures.append(self._pool.submit(_augment_batch, batch, self.augmentation, self.apply_to))
+                if self._prefetch_bounded() and len(futures) >= self.num_cached:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            # batches of an abandoned epoch are not augmented
+            for future in futures:
+                future.cancel()
 
     def get_batches(self):
         num_batches = self.data_size // self.batch_size
@@ -175,6 +257,8 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
             batches = self.generator()
             if self.augmentation is not None:
                 batches = self.augment_minibatches(batches)
+            if self.device_prefetch:
+                batches = self.stage_on_device(batches)
             batches = self.generate_in_background(batches)
             for it, batch in enumerate(batches):
                 if isinstance(self.placeholders, (list, tuple)):
@@ -190,31 +274,120 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
                     yield (self.cur_epoch * num_batches + it) if self.placeholders is not None \
                         else ((self.cur_epoch * num_batches + it), batch)
 
+    def _prefetch_bounded(self):
+        # like Queue(maxsize), num_cached <= 0 means no limit
+        return self.num_cached is not None and self.num_cached > 0
+
+    def _prefetch_group_size(self):
+        # batches are handed over in groups to save lock round trips and wake-ups
+        return max(1, min(4, self.num_cached)) if self._prefetch_bounded() else 4
+
+    def _prefetch_worker(self):
+        cv, buffer = self._prefetch_cv, self._prefetch_buffer
+        while True:
+            with cv:
+                while self._prefetch_source is None and not self._prefetch_closed:
+                    cv.wait()
+                if self._prefetch_closed:
+                    return
+                job, generator = self._prefetch_source
+                self._prefetch_source = None
+
+            group_size = self._prefetch_group_size()
+            bounded = self._prefetch_bounded()
+            pending = []
+            end = _END_OF_BATCHES
+            try:
+                for item in generator:
+                    pending.append((job, item))
+                    if len(pending) < group_size:
+                        continue
+
+                    with cv:
+                        while bounded and len(buffer) + len(pending) > self.num_cached and \
+                                self._prefetch_source is None and not self._prefetch_closed:
+                            cv.wait()
+                        if self._prefetch_source is not None or self._prefetch_closed:
+                            pending = []
+                            break
+                        buffer.extend(pending)
+                        cv.notify_all()
+                    pending = []
+            except BaseException as e:
+                # handed to the consumer. Only exits that are not Exceptions, e.g. KeyboardInterrupt, end the thread
+                end = _PrefetchError(e)
+                if not isinstance(e, Exception):
+                    raise
+            finally:
+                # runs the cleanup of an abandoned generator, e.g. cancelling queued augmentation, right away
+                if hasattr(generator, 'close'):
+                    generator.close()
+                with cv:
+                    buffer.extend(pending)
+                    buffer.append((job, end))
+                    cv.notify_all()
+
     def generate_in_background(self, generator):
         """
         Runs a generator in a background thread, caching up to `num_cached` items.
+        The thread is started once and reused by every subsequent call, and restarted if it has died.
+        An exception raised by `generator` is re-raised here.
         """
-        queue = Queue(maxsize=self.num_cached)
-
-        # define producer (putting items into queue)
-        def producer():
-            for item in generator:
-                queue.put(item)
-            queue.join()
-            queue.put(None)
-
-        # start producer (in a background thread)
-        thread = threading.Thread(target=producer)
-        thread.daemon = True
-        thread.start()
+        cv, buffer = self._prefetch_cv, self._prefetch_buffer
+        resume_at = self.num_cached - self._prefetch_group_size() if self._prefetch_bounded() else None
+        with cv:
+            if self._prefetch_thread is None or not self._prefetch_thread.is_alive():
+                self._prefetch_thread = threading.Thread(target=self._prefetch_worker)
+                self._prefetch_thread.daemon = True
+                self._prefetch_thread.start()
+
+            self._prefetch_job += 1
+            job = self._prefetch_job
+            self._prefetch_source = (job, generator)
+            cv.notify_all()
 
-        # run as consumer (read items from queue, in current thread)
         while True:
-            item = queue.get()
-            if item is None:
+            with cv:
+                while not buffer:
+                    cv.wait()
+                item_job, item = buffer.popleft()
+                # the worker only waits while a whole group does not fit, so wake it once when one does
+                if len(buffer) == resume_at:
+                    cv.notify_all()
+
+            # items left over from an abandoned generator are dropped
+            if item_job != job:
+                continue
+            if item is _END_OF_BATCHES:
                 break
+            if isinstance(item, _PrefetchError):
+                raise item.error
             yield item
-            queue.task_done()
+
+    def stage_on_device(self, minibatches):
+        """
+        Uploads the items of minibatches that are bound to GPU placeholders to the device.
+        Used by the background thread when `device_prefetch` is on, so all transfers are issued from a single thread.
+        :param minibatches:
+        :return: a generator of minibatches holding pygpu arrays in place of numpy arrays
+        """
+        import pygpu
+
+        placeholders = self.placeholders if isinstance(self.placeholders, (list, tuple)) else [self.placeholders]
+
+        def upload(data, placeholder):
+            if not isinstance(placeholder, theano.gpuarray.type.GpuArraySharedVariable):
+                return data
+            return pygpu.gpuarray.asarray(np.asarray(data, placeholder.dtype), context=placeholder.type.context)
+
+        for batch in minibatches:
+            if isinstance(batch, np.ndarray):
+                yield upload(batch, placeholders[0])
+            else:
+                batch = list(batch)
+                for i, placeholder in enumerate(placeholders[:len(batch)]):
+                    batch[i] = upload(batch[i], placeholder)
+                yield batch
 
     def update_input(self, data):
         if self.placeholders is not None:
@@ -223,10 +396,9 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
                                                             (len(data), len(self.placeholders))
                 for d, p in zip(data, self.placeholders):
                     p.set_value(d, borrow=True)
-            elif isinstance(self.placeholders, theano.gpuarray.type.GpuArraySharedVariable) and isinstance(data,
-                                                                                                           np.ndarray):
+            elif isinstance(self.placeholders, theano.gpuarray.type.GpuArraySharedVariable) and hasattr(data, 'shape'):
                 x = data
-                shape_x = self.placeholders.get_value().shape
+                shape_x = self.placeholders.get_value(borrow=True, return_internal_type=True).shape
                 if x.shape != shape_x:
                     raise ValueError('Shape mismatch. Got {} for shared variable of shape {}.'.format(x.shape, shape_x))
                 self.placeholders.set_value(x, borrow=True)
@@ -237,21 +409,22 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
 
     def generator(self):
         num_batches = self.data_size // self.batch_size
-        dataset = list(self.dataset) if isinstance(self.dataset, (list, tuple)) else np.copy(self.dataset)
+        multiple = isinstance(self.dataset, (list, tuple))
         if self.shuffle:
-            index = np.arange(0, self.data_size)
-            np.random.shuffle(index)
-            if isinstance(self.dataset, (list, tuple)):
+            if multiple:
                 assert all(isinstance(data, np.ndarray) for data in self.dataset), 'All objects in dataset should ' \
                                                                                    'be numpy ndarray objects.'
-                dataset = tuple([x[index] for x in self.dataset])
-            elif isinstance(self.dataset, np.ndarray):
-                dataset = self.dataset[index]
-            else:
+            elif not isinstance(self.dataset, np.ndarray):
                 raise TypeError('dataset should be a list, tuple or numpy ndarray, got %s.' % type(self.dataset))
-        for i in range(num_batches):
-            yield [data[i * self.batch_size:(i + 1) * self.batch_size] for data in dataset] \
-                if isinstance(self.dataset, (list, tuple)) else dataset[i * self.batch_size:(i + 1) * self.batch_size]
+
+            # only the indices are shuffled; each batch gathers its own rows
+            index = np.random.permutation(self.data_size)[:num_batches * self.batch_size]
+            batches = index.reshape((num_batches, self.batch_size))
+        else:
+            batches = [slice(i * self.batch_size, (i + 1) * self.batch_size) for i in range(num_batches)]
+
+        for batch in batches:
+            yield [data[batch] for data in self.dataset] if multiple else self.dataset[batch]
 
 
 def progress(items, desc='', total=None, min_delay=0.1):
@@ -281,6 +454,26 @@ def progress(items, desc='', total=None, min_delay=0.1):
     print("\r%s%d/%d (100.00%%) (took %d:%02d)" % ((desc, total, total) + divmod(t_total, 60)))
 
 
+def imresize(image, size, interpolation=None):
+    """
+    Resizes an image with OpenCV, following the conventions of the removed `scipy.misc.imresize`: an image that is not
+    uint8 is first rescaled linearly from its own min-max range to 0-255, and the result is always uint8.
+
+    :param image: a 2D or an HWC numpy array
+    :param size: (height, width) of the output
+    :param interpolation: an OpenCV interpolation flag. Default is bilinear
+    :return: the resized uint8 image
+    """
+    import cv2
+
+    if image.dtype != np.uint8:
+        low, high = image.min(), image.max()
+        scale = 255. / (high - low if high > low else 1.)
+        image = (np.clip((image - low) * scale, 0, 255) + .5).astype(np.uint8)
+    interpolation = cv2.INTER_LINEAR if interpolation is None else interpolation
+    return cv2.resize(image, (size[1], size[0]), interpolation=interpolation)
+
+
 def crop_center(image, crop, resize=None):
     crop = (crop, crop) if isinstance(crop, int) else crop
     if resize:
@@ -290,7 +483,7 @@ def crop_center(image, crop, resize=None):
             newh, neww = resize, int(scale * w + 0.5)
         else:
             newh, neww = int(scale * h + 0.5), resize
-        image = misc.imresize(image, (newh, neww))
+        image = imresize(image, (newh, neww))
 
     orig_shape = image.shape
     h0 = int((orig_shape[0] - crop[0]) * 0.5)
@@ -308,7 +501,7 @@ def crop_random(image, crop, resize=None):
             newh, neww = resize, int(scale * w + 0.5)
         else:
             newh, neww = int(scale * h + 0.5), resize
-        image = misc.imresize(image, (newh, neww))
+        image = imresize(image, (newh, neww))
 
     def _get_params():
         h, w = image.shape[:2]
@@ -334,7 +527,14 @@ def prep_image(fname, mean_bgr, color='bgr', resize=256):
     :param resize:
     :return:
     """
-    im = misc.imread(fname)
+    import cv2
+
+    if color not in ('bgr', 'rgb'):
+        raise NotImplementedError
+
+    im = cv2.imread(fname, cv2.IMREAD_COLOR)  # BGR
+    if im is None:
+        raise IOError('Unable to read image %s.' % fname)
 
     # Resize
     h, w, _ = im.shape
@@ -342,22 +542,19 @@ def prep_image(fname, mean_bgr, color='bgr', resize=256):
         new_sh = (resize, int(w * resize / h))
     else:
         new_sh = (int(h * resize / w), resize)
-    im = misc.imresize(im, new_sh, interp='bicubic')
+    im = imresize(im, new_sh, cv2.INTER_CUBIC)
 
     # Crop center 224, 224
     h, w = new_sh
     im = im[h // 2 - 112:h // 2 + 112, w // 2 - 112:w // 2 + 112]
 
-    rawim = np.copy(im).astype('uint8')
+    rawim = np.ascontiguousarray(im[:, :, ::-1])
 
     im = im.astype(theano.config.floatX)
-    if color == 'bgr':
-        im = im[:, :, ::-1] - mean_bgr
-    elif color == 'rgb':
-        im = im - mean_bgr[:, :, ::-1]
-    else:
-        raise NotImplementedError
-    return rawim, np.transpose(im[None], (0, 3, 1, 2))
+    im -= mean_bgr
+    if color == 'rgb':
+        im = im[:, :, ::-1]
+    return rawim, np.ascontiguousarray(im.transpose((2, 0, 1)))[None]
 
 
 def prep_image2(fname, mean, std=None, resize=256):
@@ -369,7 +566,11 @@ def prep_image2(fname, mean, std=None, resize=256):
     :param resize:
     :return:
     """
-    im = misc.imread(fname)
+    import cv2
+
+    im = cv2.imread(fname, cv2.IMREAD_COLOR)
+    if im is None:
+        raise IOError('Unable to read image %s.' % fname)
 
     # Resize
     h, w, _ = im.shape
@@ -377,18 +578,19 @@ def prep_image2(fname, mean, std=None, resize=256):
         new_sh = (resize, int(w * resize / h))
     else:
         new_sh = (int(h * resize / w), resize)
-    im = misc.imresize(im, new_sh, interp='bicubic')
+    im = imresize(im, new_sh, cv2.INTER_CUBIC)
 
     # Crop center 224, 224
     h, w = new_sh
-    im = im[h // 2 - 112:h // 2 + 112, w // 2 - 112:w // 2 + 112]
-    rawim = np.copy(im).astype('uint8')
+    im = im[h // 2 - 112:h // 2 + 112, w // 2 - 112:w // 2 + 112, ::-1]  # BGR -> RGB
+    rawim = np.ascontiguousarray(im)
 
-    im = im.astype(theano.config.floatX) / 255.
+    im = im.astype(theano.config.floatX)
+    im /= 255.
     im -= mean
     if std is not None:
         im /= std
-    return rawim, np.transpose(im[None], (0, 3, 1, 2))
+    return rawim, np.ascontiguousarray(im.transpose((2, 0, 1)))[None]
 
 
 def convert_kernel(kernel):
@@ -412,20 +614,14 @@ def convert_kernel(kernel):
 
 def convert_dense_weights_data_format(weights, previous_feature_map_shape, target_data_format='channels_first'):
     assert target_data_format in {'channels_last', 'channels_first'}
-    kernel = np.array(weights, theano.config.floatX)
-    for i in range(kernel.shape[1]):
-        if target_data_format == 'channels_first':
-            c, h, w = previous_feature_map_shape
-            original_fm_shape = (h, w, c)
-            ki = kernel[:, i].reshape(original_fm_shape)
-            ki = np.transpose(ki, (2, 0, 1))  # last -> first
-        else:
-            h, w, c = previous_feature_map_shape
-            original_fm_shape = (c, h, w)
-            ki = kernel[:, i].reshape(original_fm_shape)
-            ki = np.transpose(ki, (1, 2, 0))  # first -> last
-        kernel[:, i] = np.reshape(ki, (np.prod(previous_feature_map_shape),))
-    return kernel
+    kernel = np.asarray(weights, theano.config.floatX)
+    if target_data_format == 'channels_first':
+        c, h, w = previous_feature_map_shape
+        kernel = kernel.reshape((h, w, c, -1)).transpose((2, 0, 1, 3))  # last -> first
+    else:
+        h, w, c = previous_feature_map_shape
+        kernel = kernel.reshape((c, h, w, -1)).transpose((1, 2, 0, 3))  # first -> last
+    return np.ascontiguousarray(kernel.reshape((h * w * c, -1)))
 
 
 def maxout(input, **kwargs):
@@ -474,29 +670,41 @@ def inference(input, model):
     return feed
 
 
-def rgb2gray(img):
+_RGB2GRAY = np.array([.299, .587, .114], theano.config.floatX)
+# column k holds the weights of the input channels for output channel k
+_RGB2YCBCR = np.array([[.299, -.169, .5], [.587, -.331, -.419], [.114, .5, -.081]], theano.config.floatX)
+_RGB2YCBCR_BIAS = np.array([0., 128., 128.], theano.config.floatX)
+_YCBCR2RGB = np.array([[1., 1., 1.], [0., -.343, 1.765], [1.4, -.711, 0.]], theano.config.floatX)
+_YCBCR2RGB_BIAS = -_RGB2YCBCR_BIAS.dot(_YCBCR2RGB)
+
+
+def _mix_channels(img, matrix, bias=None):
+    """
+    Applies a linear color transform to a batch of images in one tensordot.
+
+    :param img: a 4D tensor in NCHW format
+    :param matrix: a (C_in,) or (C_in, C_out) numpy array
+    :param bias: an optional (C_out,) numpy array added to the output
+    :return: a 4D tensor in NCHW format
+    """
     if img.ndim != 4:
         raise ValueError('Input images must have four dimensions, not %d' % img.ndim)
-    return (0.299 * img[:, 0] + 0.587 * img[:, 1] + 0.114 * img[:, 2]).dimshuffle((0, 'x', 1, 2))
+
+    out = T.tensordot(img, matrix, axes=[[1], [0]])
+    out = out.dimshuffle((0, 'x', 1, 2)) if matrix.ndim == 1 else out.dimshuffle((0, 3, 1, 2))
+    return out if bias is None else out + bias.reshape((1, -1, 1, 1))
+
+
+def rgb2gray(img):
+    return _mix_channels(img, _RGB2GRAY)
 
 
 def rgb2ycbcr(img):
-    if img.ndim != 4:
-        raise ValueError('Input images must have four dimensions, not %d' % img.ndim)
-    Y = 0. + .299 * img[:, 0] + .587 * img[:, 1] + .114 * img[:, 2]
-    Cb = 128. - .169 * img[:, 0] - .331 * img[:, 1] + .5 * img[:, 2]
-    Cr = 128. + .5 * img[:, 0] - .419 * img[:, 1] - .081 * img[:, 2]
-    return T.concatenate((Y.dimshuffle((0, 'x', 1, 2)), Cb.dimshuffle((0, 'x', 1, 2)), Cr.dimshuffle((0, 'x', 1, 2))),
-                         1)
+    return _mix_channels(img, _RGB2YCBCR, _RGB2YCBCR_BIAS)
 
 
 def ycbcr2rgb(img):
-    if img.ndim != 4:
-        raise ValueError('Input images must have four dimensions, not %d' % img.ndim)
-    R = img[:, 0] + 1.4 * (img[:, 2] - 128.)
-    G = img[:, 0] - .343 * (img[:, 1] - 128.) - .711 * (img[:, 2] - 128.)
-    B = img[:, 0] + 1.765 * (img[:, 1] - 128.)
-    return T.concatenate((R.dimshuffle((0, 'x', 1, 2)), G.dimshuffle((0, 'x', 1, 2)), B.dimshuffle((0, 'x', 1, 2))), 1)
+    return _mix_channels(img, _YCBCR2RGB, _YCBCR2RGB_BIAS)
 
 
 def rgb2yiq(img):
@@ -542,9 +750,7 @@ def _meshgrid(height, width):
     #  ones = np.ones(np.prod(x_t.shape))
     #  grid = np.vstack([x_t.flatten(), y_t.flatten(), ones])
     # It is implemented in Theano instead to support symbolic grid sizes.
-    # Note: If the image size is known at layer construction time, we could
-    # compute the meshgrid offline in numpy instead of doing it dynamically
-    # in Theano. However, it hardly affected performance when we tried.
+    # If the image size is known at graph construction time, use _meshgrid_np.
     x_t = T.dot(T.ones((height, 1)), linspace(-1.0, 1.0, width).dimshuffle('x', 0))
     y_t = T.dot(linspace(-1.0, 1.0, height).dimshuffle(0, 'x'), T.ones((1, width)))
 
@@ -555,6 +761,15 @@ def _meshgrid(height, width):
     return grid
 
 
+@lru_cache(maxsize=None)
+def _meshgrid_np(height, width):
+    # Constant version of _meshgrid for static grid sizes. The result is cached and read-only.
+    x_t, y_t = np.meshgrid(np.linspace(-1, 1, width), np.linspace(-1, 1, height))
+    grid = np.vstack([x_t.flatten(), y_t.flatten(), np.ones(height * width)]).astype(theano.config.floatX)
+    grid.flags.writeable = False
+    return grid
+
+
 def interpolate_bilinear(im, x, y, out_shape=None, border_mode='nearest'):
     if im.ndim != 4:
         raise TypeError('im should be a 4D Tensor image, got %dD.' % im.ndim)
@@ -575,27 +790,21 @@ def interpolate_bilinear(im, x, y, out_shape=None, border_mode='nearest'):
     x1_f = x0_f + 1
     y1_f = y0_f + 1
 
+    # all four corner coordinates are bounded in one op against their axis size
+    coords = T.stack([x0_f, x1_f, y0_f, y1_f])
+    sizes = T.stack([width_f, width_f, height_f, height_f]).dimshuffle(0, 'x')
     if border_mode == 'nearest':
-        x0 = T.clip(x0_f, 0, width_f - 1)
-        x1 = T.clip(x1_f, 0, width_f - 1)
-        y0 = T.clip(y0_f, 0, height_f - 1)
-        y1 = T.clip(y1_f, 0, height_f - 1)
+        coords = T.clip(coords, 0, sizes - 1)
     elif border_mode == 'mirror':
-        w = 2 * (width_f - 1)
-        x0 = T.minimum(x0_f % w, -x0_f % w)
-        x1 = T.minimum(x1_f % w, -x1_f % w)
-        h = 2 * (height_f - 1)
-        y0 = T.minimum(y0_f % h, -y0_f % h)
-        y1 = T.minimum(y1_f % h, -y1_f % h)
+        periods = 2 * (sizes - 1)
+        coords = T.minimum(coords % periods, -coords % periods)
     elif border_mode == 'wrap':
-        x0 = T.mod(x0_f, width_f)
-        x1 = T.mod(x1_f, width_f)
-        y0 = T.mod(y0_f, height_f)
-        y1 = T.mod(y1_f, height_f)
+        coords = T.mod(coords, sizes)
     else:
         raise ValueError("border_mode must be one of "
                          "'nearest', 'mirror', 'wrap'")
-    x0, x1, y0, y1 = (T.cast(v, 'int64') for v in (x0, x1, y0, y1))
+    coords = T.cast(coords, 'int64')
+    x0, x1, y0, y1 = coords[0], coords[1], coords[2], coords[3]
 
     base = T.arange(n) * w * h
     base = T.reshape(base, (-1, 1))
@@ -615,25 +824,34 @@ def interpolate_bilinear(im, x, y, out_shape=None, border_mode='nearest'):
     pixel_c = im_flat[idx_c]
     pixel_d = im_flat[idx_d]
 
-    wa = ((x1_f - x) * (y1_f - y)).dimshuffle((0, 'x'))
-    wb = ((x1_f - x) * (1. - (y1_f - y))).dimshuffle((0, 'x'))
-    wc = ((1. - (x1_f - x)) * (y1_f - y)).dimshuffle((0, 'x'))
-    wd = ((1. - (x1_f - x)) * (1. - (y1_f - y))).dimshuffle((0, 'x'))
+    dx = x1_f - x
+    dy = y1_f - y
+    wa = (dx * dy).dimshuffle((0, 'x'))
+    wb = (dx * (1. - dy)).dimshuffle((0, 'x'))
+    wc = ((1. - dx) * dy).dimshuffle((0, 'x'))
+    wd = ((1. - dx) * (1. - dy)).dimshuffle((0, 'x'))
 
-    output = T.sum((wa * pixel_a, wb * pixel_b, wc * pixel_c, wd * pixel_d), axis=0)
+    output = wa * pixel_a + wb * pixel_b + wc * pixel_c + wd * pixel_d
     output = T.reshape(output, (n, h_out, w_out, c))
     return output.dimshuffle((0, 3, 1, 2))
 
 
-def transform_affine(theta, input, downsample_factor=(1, 1), border_mode='nearest'):
+def transform_affine(theta, input, downsample_factor=(1, 1), border_mode='nearest', input_shape=None):
     n, c, h, w = input.shape
     theta = T.reshape(theta, (-1, 2, 3))
 
-    h_out = T.cast(h // downsample_factor[0], 'int64')
-    w_out = T.cast(w // downsample_factor[1], 'int64')
-    grid = _meshgrid(h_out, w_out)
+    sizes = tuple(input_shape[2:]) if input_shape is not None else (None, None)
+    if all(isinstance(size, (int, np.integer)) for size in sizes):
+        h_out = int(sizes[0]) // downsample_factor[0]
+        w_out = int(sizes[1]) // downsample_factor[1]
+        grid = _meshgrid_np(h_out, w_out)
+    else:
+        h_out = T.cast(h // downsample_factor[0], 'int64')
+        w_out = T.cast(w // downsample_factor[1], 'int64')
+        grid = _meshgrid(h_out, w_out)
 
-    Tg = T.dot(theta, grid)
+    # all transforms share the grid, so (N*2, 3) x (3, H*W) is one plain GEMM instead of a batched one
+    Tg = T.dot(theta.reshape((-1, 3)), grid).reshape((theta.shape[0], 2, -1))
     xs = Tg[:, 0]
     ys = Tg[:, 1]
     return interpolate_bilinear(input, xs, ys, (h_out, w_out), border_mode)
@@ -721,14 +939,35 @@ def unroll_scan(fn, sequences, outputs_info, non_sequences, n_steps, go_backward
     return output_scan if len(output_scan) > 1 else output_scan[0]
 
 
+def _balanced_reduce(func, items):
+    # pairwise reduction, so the expression tree has logarithmic rather than linear depth
+    items = list(items)
+    while len(items) > 1:
+        items = [func(*items[i:i + 2]) if i + 1 < len(items) else items[i] for i in range(0, len(items), 2)]
+    return items[0]
+
+
 def lagrange_interpolation(x, y, u, order):
     r = range(order + 1)
-    a = [y[i] / reduce(lambda c, b: c * b, [x[i] - x[j] for j in r if j != i]) for i in r]
-    out = T.sum([a[i] * reduce(lambda c, b: c * b, [u - x[j] for j in r if j != i]) for i in r], 0)
-    return out
+    a = [y[i] / reduce(operator.mul, [x[i] - x[j] for j in r if j != i]) for i in r]
+    diffs = [u - x[j] for j in r]
+    terms = [a[i] * _balanced_reduce(operator.mul, [diffs[j] for j in r if j != i]) for i in r]
+    return _balanced_reduce(operator.add, terms)
 
 
 def point_op(image, lut, origin, increment, *args):
+    if isinstance(image, np.ndarray):
+        try:
+            from .utils_numba import point_op_np
+        except ImportError:
+            lut = np.asarray(lut)
+            pos = (image - origin) / increment
+            index = np.clip(pos.astype('int64'), 0, lut.shape[0] - 2)
+            lower = np.take(lut, index)
+            res = lower + (np.take(lut, index + 1) - lower) * (pos - index)
+            return res.astype(theano.config.floatX)
+        return point_op_np(image, np.asarray(lut), origin, increment, theano.config.floatX)
+
     h, w = image.shape
     im = image.flatten()
     lutsize = lut.shape[0] - 2
@@ -741,18 +980,21 @@ def point_op(image, lut, origin, increment, *args):
     return T.reshape(res, (h, w)).astype(theano.config.floatX)
 
 
+@lru_cache(maxsize=128)
 def get_kernel(factor, kernel_type, phase, kernel_width, support=None, sigma=None):
+    # the result is cached, so it is returned read-only
     assert kernel_type in ['lanczos', 'gauss', 'box']
 
     # factor  = float(factor)
     if phase == 0.5 and kernel_type != 'box':
-        kernel = np.zeros([kernel_width - 1, kernel_width - 1])
+        size = kernel_width - 1
     else:
-        kernel = np.zeros([kernel_width, kernel_width])
+        size = kernel_width
+    idx = np.arange(1, size + 1)
 
     if kernel_type == 'box':
         assert phase == 0.5, 'Box filter is always half-phased'
-        kernel[:] = 1. / (kernel_width * kernel_width)
+        kernel = np.full([size, size], 1. / (kernel_width * kernel_width))
 
     elif kernel_type == 'gauss':
         assert sigma, 'sigma is not specified'
@@ -761,43 +1003,25 @@ def get_kernel(factor, kernel_type, phase, kernel_width, support=None, sigma=Non
         center = (kernel_width + 1.) / 2.
         sigma_sq = sigma * sigma
 
-        for i in range(1, kernel.shape[0] + 1):
-            for j in range(1, kernel.shape[1] + 1):
-                di = (i - center) / 2.
-                dj = (j - center) / 2.
-                kernel[i - 1][j - 1] = np.exp(-(di * di + dj * dj) / (2 * sigma_sq))
-                kernel[i - 1][j - 1] = kernel[i - 1][j - 1] / (2. * np.pi * sigma_sq)
+        # the kernel is separable: exp(-(di^2 + dj^2) / 2s^2) = exp(-di^2 / 2s^2) * exp(-dj^2 / 2s^2)
+        d = (idx - center) / 2.
+        g = np.exp(-d * d / (2 * sigma_sq))
+        kernel = np.outer(g, g) / (2. * np.pi * sigma_sq)
     elif kernel_type == 'lanczos':
         assert support, 'support is not specified'
         center = (kernel_width + 1) / 2.
 
-        for i in range(1, kernel.shape[0] + 1):
-            for j in range(1, kernel.shape[1] + 1):
-
-                if phase == 0.5:
-                    di = abs(i + 0.5 - center) / factor
-                    dj = abs(j + 0.5 - center) / factor
-                else:
-                    di = abs(i - center) / factor
-                    dj = abs(j - center) / factor
-
-                pi_sq = np.pi * np.pi
-
-                val = 1
-                if di != 0:
-                    val = val * support * np.sin(np.pi * di) * np.sin(np.pi * di / support)
-                    val = val / (pi_sq * di * di)
-
-                if dj != 0:
-                    val = val * support * np.sin(np.pi * dj) * np.sin(np.pi * dj / support)
-                    val = val / (pi_sq * dj * dj)
-
-                kernel[i - 1][j - 1] = val
+        d = np.abs(idx + (0.5 if phase == 0.5 else 0.) - center) / factor
+        # support * sin(pi * d) * sin(pi * d / support) / (pi * d)^2, which is 1 at d = 0
+        l = np.sinc(d) * np.sinc(d / support)
+        kernel = np.outer(l, l)
     else:
         assert False, 'Wrong method name.'
 
     kernel /= kernel.sum()
-    return floatX(kernel)
+    kernel = floatX(kernel)
+    kernel.flags.writeable = False
+    return kernel
 
 
 def constant_pad(input, padding, constant=0):
@@ -845,20 +1069,23 @@ def replication_pad(input, padding):
     if isinstance(padding, int):
         padding = (padding,) * 4
 
-    input = T.as_tensor(input)
-    output = input
-    for axis, i in enumerate(padding):
-        for _ in range(i):
-            if axis == 0:
-                output = T.concatenate((G.disconnected_grad(output[:, :, :, :1]), output), 3)
-            elif axis == 1:
-                output = T.concatenate((output, G.disconnected_grad(output[:, :, :, -1:])), 3)
-            elif axis == 2:
-                output = T.concatenate((G.disconnected_grad(output[:, :, :1]), output), 2)
-            elif axis == 3:
-                output = T.concatenate((output, G.disconnected_grad(output[:, :, -1:])), 2)
-            else:
-                raise ValueError('padding must have 4 elements. Received %d.' % len(padding))
+    if len(padding) > 4:
+        raise ValueError('padding must have 4 elements. Received %d.' % len(padding))
+
+    left, right, top, bottom = tuple(padding) + (0,) * (4 - len(padding))
+    output = T.as_tensor(input)
+    for axis, before, after in ((3, left, right), (2, top, bottom)):
+        if not before and not after:
+            continue
+
+        first = output[(slice(None),) * axis + (slice(None, 1),)]
+        last = output[(slice(None),) * axis + (slice(-1, None),)]
+        parts = [output]
+        if before:
+            parts.insert(0, T.repeat(G.disconnected_grad(first), before, axis))
+        if after:
+            parts.append(T.repeat(G.disconnected_grad(last), after, axis))
+        output = T.concatenate(parts, axis)
     return output
 
 
@@ -878,55 +1105,31 @@ def reflection_pad(input, padding, batch_ndim=2):
         Dimensions before the value will not be padded.
     """
 
-    # Idea for how to make this happen: Flip the tensor horizontally to grab horizontal values,
-    # then vertically to grab vertical values
-    # alternatively, just slice correctly
     if np.all(np.array(padding) == 0):
         return input
 
     input = T.as_tensor(input)
-    input_shape = input.shape
-    input_ndim = input.ndim
-
-    output_shape = list(input_shape)
-    indices = [slice(None) for _ in output_shape]
-
     if isinstance(padding, int):
-        widths = [padding] * (input_ndim - batch_ndim)
+        widths = [padding] * (input.ndim - batch_ndim)
     else:
         widths = padding
 
+    # reflect one axis at a time, so the corners are reflections of the already padded borders
+    output = input
     for k, w in enumerate(widths):
         try:
             l, r = w
         except TypeError:
             l = r = w
-        output_shape[k + batch_ndim] += l + r
-        indices[k + batch_ndim] = slice(l, l + input_shape[k + batch_ndim])
-
-    # Create output array
-    out = T.zeros(output_shape)
-
-    # Vertical Reflections
-    # out[:,:,:width,width:-width] = x[:,:,width:0:-1,:]
-    out = T.set_subtensor(out[:, :, :widths[0], widths[1]:-widths[1]],
-                          G.disconnected_grad(input[:, :, widths[0]:0:-1, :]))
-    # out[:,:,-width:,width:-width] = x[:,:,-2:-(2+width):-1,:]
-    out = T.set_subtensor(out[:, :, -widths[0]:, widths[1]:-widths[1]],
-                          G.disconnected_grad(input[:, :, -2:-(2 + widths[0]):-1, :]))
-
-    # Place X in out
-    # out = T.set_subtensor(out[tuple(indices)], x) # or, alternative, out[width:-width,width:-width] = x
-    # out[:,:,width:-width,width:-width] = x
-    out = T.set_subtensor(out[:, :, widths[0]:-widths[0], widths[1]:-widths[1]], input)
-
-    # Horizontal reflections
-    # out[:,:,:,:width] = out[:,:,:,(2*width):width:-1]
-    out = T.set_subtensor(out[:, :, :, :widths[1]], G.disconnected_grad(out[:, :, :, (2 * widths[1]):widths[1]:-1]))
-    # out[:,:,:,-width:] = out[:,:,:,-(width+2):-(2*width+2):-1]
-    out = T.set_subtensor(out[:, :, :, -widths[1]:],
-                          G.disconnected_grad(out[:, :, :, -(widths[1] + 2):-(2 * widths[1] + 2):-1]))
-    return out
+        if not l and not r:
+            continue
+
+        axis = k + batch_ndim
+        lead = (slice(None),) * axis
+        before = G.disconnected_grad(output[lead + (slice(l, 0, -1),)])
+        after = G.disconnected_grad(output[lead + (slice(-2, -(2 + r), -1),)])
+        output = T.concatenate([before, output, after], axis)
+    return output
 
 
 def mean_interp_pad(x, padding):
@@ -957,9 +1160,10 @@ def unpool(input, shape):
     assert isinstance(shape, (list, tuple, int)), 'shape must be a list, tuple, or int, got %s' % type(shape)
 
     shape = tuple(shape) if isinstance(shape, (list, tuple)) else (shape, shape)
-    output = T.repeat(input, shape[0], 2)
-    output = T.repeat(output, shape[1], 3)
-    return output
+    n, c, h, w = input.shape
+    # broadcast each pixel over a (shape[0], shape[1]) block, then merge the block axes into the spatial ones
+    output = input.dimshuffle(0, 1, 2, 'x', 3, 'x') * T.ones((1, 1, 1, shape[0], 1, shape[1]), input.dtype)
+    return T.reshape(output, (n, c, h * shape[0], w * shape[1]))
 
 
 def batch_set_value(tuples):
@@ -990,8 +1194,10 @@ def make_tensor_kernel_from_numpy(kern_shape, numpy_kernel, type='each'):
     return kern
 
 
+@lru_cache(maxsize=128)
 def gaussian2(size, sigma):
-    """Returns a normalized circularly symmetric 2D gauss kernel array
+    """Returns a normalized circularly symmetric 2D gauss kernel array.
+    The result is cached and read-only.
 
     f(x,y) = A.e^{-(x^2/2*sigma^2 + y^2/2*sigma^2)} where
 
@@ -1000,9 +1206,27 @@ def gaussian2(size, sigma):
     as define by Wolfram Mathworld
     http://mathworld.wolfram.com/GaussianFunction.html
     """
-    A = 1. / (2. * np.pi * sigma ** 2)
-    x, y = np.mgrid[-size // 2 + 1:size // 2 + 1, -size // 2 + 1:size // 2 + 1]
-    g = A * np.exp(-((x ** 2 / (2. * sigma ** 2)) + (y ** 2 / (2. * sigma ** 2))))
+    try:
+        from .utils_numba import gaussian2_np
+        g = gaussian2_np(size, sigma)
+    except ImportError:
+        t = np.arange(-size // 2 + 1, size // 2 + 1, dtype=np.float32)
+        s2 = np.float32(2. * sigma ** 2)
+        e = np.exp(-t * t / s2)
+        g = np.float32(1. / (np.pi * s2)) * np.outer(e, e)
+    g.flags.writeable = False
+    return g
+
+
+def gaussian1d(size, sigma):
+    """Returns a 1D gauss kernel array whose outer product with itself is the kernel from :func:`gaussian2`
+
+    f(x) = A.e^{-x^2/2*sigma^2} where
+
+    A = 1/(sqrt(2*pi)*sigma)
+    """
+    x = np.arange(-size // 2 + 1, size // 2 + 1)
+    g = np.exp(-x ** 2 / (2. * sigma ** 2)) / (np.sqrt(2. * np.pi) * sigma)
     return np.float32(g)
 
 
@@ -1016,27 +1240,50 @@ def laplacian_of_gaussian_kernel(size, sigma):
     as define by Wolfram Mathworld
     http://mathworld.wolfram.com/GaussianFunction.html
     """
-    x, y = np.mgrid[-size // 2 + 1:size // 2 + 1, -size // 2 + 1:size // 2 + 1]
-    g = 1 / (2 * np.pi * sigma ** 4) * ((x ** 2 + y ** 2 - 2 * sigma ** 2) / sigma ** 2) * np.exp(
-        -(x ** 2 + y ** 2) / (2 * sigma ** 2))
-    return np.float32(g)
+    x, y = np.mgrid[-size // 2 + 1:size // 2 + 1, -size // 2 + 1:size // 2 + 1].astype(np.float32)
+    s2 = np.float32(sigma ** 2)
+    r2 = x * x + y * y
+    return np.float32(1. / (2. * np.pi * sigma ** 4)) * (r2 - 2 * s2) / s2 * np.exp(-r2 / (2 * s2))
+
+
+@lru_cache(maxsize=64)
+def _fspecial_gauss(size, sigma):
+    t = np.arange(-size // 2 + 1, size // 2 + 1)
+    e = np.exp(-t * t / (2.0 * sigma ** 2))
+    g = np.outer(e, e)
+    return T.constant(floatX(g / np.sum(g)))
 
 
 def fspecial_gauss(size, sigma):
-    """Function to mimic the 'fspecial' gaussian MATLAB function
+    """Function to mimic the 'fspecial' gaussian MATLAB function.
+    When `size` and `sigma` are numbers, the window is computed in numpy and returned as a cached constant.
     """
-    x, y = T.mgrid[-size // 2 + 1:size // 2 + 1, -size // 2 + 1:size // 2 + 1]
-    g = T.exp(-((T.cast(x, theano.config.floatX) ** 2 + T.cast(y, theano.config.floatX) ** 2) / (2.0 * sigma ** 2)))
+    if isinstance(size, (int, np.integer)) and isinstance(sigma, (int, float, np.number)):
+        return _fspecial_gauss(int(size), float(sigma))
+
+    # exp(-(x^2 + y^2) / 2s^2) is the outer product of a 1D window with itself
+    t = T.cast(T.arange(-size // 2 + 1, size // 2 + 1), theano.config.floatX)
+    e = T.exp(-t * t / (2.0 * sigma ** 2))
+    g = e.dimshuffle(0, 'x') * e.dimshuffle('x', 0)
     return g / T.sum(g)
 
 
+def _separable_depthwise_conv(x, kern, depth):
+    # filters every channel on its own with the 1D kernel, first along the rows and then along the columns
+    size = kern.shape[0]
+    kern = floatX(np.tile(kern, (depth, 1, 1, 1)))
+    x = T.nnet.conv2d(x, kern, border_mode=(0, size // 2), num_groups=depth)
+    return T.nnet.conv2d(x, kern.transpose(0, 1, 3, 2), border_mode=(size // 2, 0), num_groups=depth)
+
+
 def difference_of_gaussian(x, size=21, sigma1=1, sigma2=1.6, depth=3):
-    kern1 = gaussian2(size, sigma1)
-    kern2 = gaussian2(size, sigma2)
-    kern1 = make_tensor_kernel_from_numpy((depth, depth), kern1)
-    kern2 = make_tensor_kernel_from_numpy((depth, depth), kern2)
-    x1 = T.nnet.conv2d(x, kern1, border_mode='half')
-    x2 = T.nnet.conv2d(x, kern2, border_mode='half')
+    # conv(x, k2) - conv(x, k1) = conv(x, k2 - k1) costs size^2 MACs per pixel, the two separable filters 4 * size
+    if size < 4:
+        kern = floatX(np.tile(gaussian2(size, sigma2) - gaussian2(size, sigma1), (depth, 1, 1, 1)))
+        return T.nnet.conv2d(x, kern, border_mode='half', num_groups=depth)
+
+    x1 = _separable_depthwise_conv(x, gaussian1d(size, sigma1), depth)
+    x2 = _separable_depthwise_conv(x, gaussian1d(size, sigma2), depth)
     return x2 - x1
 
 
@@ -1051,14 +1298,10 @@ def pad(img, mul):
     h_new = int(np.ceil(img.shape[0] / mul[0])) * mul[0]
     w_new = int(np.ceil(img.shape[1] / mul[1])) * mul[1]
 
-    new_shape = list(img.shape)
-    new_shape[0], new_shape[1] = h_new, w_new
-    out = np.zeros(new_shape, img.dtype)
-    start_x = (w_new - img.shape[1]) // 2
-    start_y = (h_new - img.shape[0]) // 2
-
-    out[start_y:start_y + img.shape[0], start_x:start_x + img.shape[1]] = img
-    return out
+    top = (h_new - img.shape[0]) // 2
+    left = (w_new - img.shape[1]) // 2
+    pad_width = ((top, h_new - img.shape[0] - top), (left, w_new - img.shape[1] - left)) + ((0, 0),) * (img.ndim - 2)
+    return np.pad(img, pad_width, mode='constant')
 
 
 def unpad(img, old_shape):
@@ -1080,6 +1323,8 @@ def depth_to_space(x, upscale_factor):
     oh = h * upscale_factor
     ow = w * upscale_factor
 
+    # splitting the channels is a view and the dimshuffle only permutes strides, so the pixels are moved exactly
+    # once, by the final reshape. Any pixel shuffle needs that one copy since the output layout differs.
     z = T.reshape(x, (n, oc, upscale_factor, upscale_factor, h, w))
     z = z.dimshuffle(0, 1, 4, 2, 5, 3)
     return T.reshape(z, (n, oc, oh, ow))
@@ -1096,6 +1341,34 @@ def space_to_depth(x, downscale_factor):
     return T.reshape(z, (n, oc, oh, ow))
 
 
+def to_nchwc(x, block=16):
+    """
+    converts an NCHW tensor to the blocked NCHW[block]c layout
+
+    :param x: a 4D tensor whose number of channels is a multiple of `block`
+    :param block: number of channels per block
+    :return: a 5D tensor of shape (N, C // block, H, W, block)
+    """
+    from theano.tensor.opt import Assert
+
+    n, c, h, w = x.shape
+    x = Assert('to_nchwc: the number of channels must be a multiple of block=%d' % block)(x, T.eq(c % block, 0))
+    z = T.reshape(x, (n, c // block, block, h, w))
+    return z.dimshuffle(0, 1, 3, 4, 2)
+
+
+def from_nchwc(x):
+    """
+    converts a tensor in the blocked NCHW[block]c layout back to NCHW
+
+    :param x: a 5D tensor of shape (N, C // block, H, W, block)
+    :return: a 4D tensor of shape (N, C, H, W)
+    """
+    n, cb, h, w, block = x.shape
+    z = x.dimshuffle(0, 1, 4, 2, 3)
+    return T.reshape(z, (n, cb * block, h, w))
+
+
 def gauss_reparametrize(mu, logvar, n_sample=1, clip=None):
     """Gaussian reparametrization"""
     std = T.exp(.5 * logvar)
@@ -1108,11 +1381,32 @@ def gauss_reparametrize(mu, logvar, n_sample=1, clip=None):
 
 
 def save(obj, file):
-    with open(file, 'wb') as f:
+    import pickle as pkl
+    import cloudpickle as cpkl
+
+    # from protocol 5 on, numpy arrays are written straight from their memory; the large buffer batches the small
+    # records in between into few writes
+    with open(file, 'wb', buffering=1 << 20) as f:
         cpkl.dump(obj, f, pkl.HIGHEST_PROTOCOL)
 
 
-def numpy2shared(numpy_vars, shared_vars=None):
+@lru_cache(maxsize=None)
+def _set_value_executor(num_workers):
+    # one pool per size, kept for the whole session instead of being created on every call
+    return ThreadPoolExecutor(num_workers)
+
+
+def numpy2shared(numpy_vars, shared_vars=None, borrow=False, num_workers=1):
+    """
+    Copies numpy arrays into shared variables, or creates new shared variables holding them.
+
+    :param numpy_vars: a numpy array or a list/tuple of numpy arrays
+    :param shared_vars: shared variables to be updated. If None, new shared variables are returned
+    :param borrow: whether the shared variables may alias `numpy_vars`. Only set if the arrays are not modified later
+    :param num_workers: number of threads updating a list of `shared_vars` concurrently. Defaults to 1, which updates
+    them in order from the calling thread. Only raise it for CPU variables: the gpuarray context is not thread-safe
+    :return: the new shared variables if `shared_vars` is None
+    """
     assert isinstance(numpy_vars, (list, tuple, np.ndarray)), 'numpy_vars must be a numpy ndarray, list or ' \
                                                               'tuple of numpy arrays, got %s' % type(
         numpy_vars)
@@ -1120,32 +1414,86 @@ def numpy2shared(numpy_vars, shared_vars=None):
         assert isinstance(shared_vars,
                           (list, tuple, T.sharedvar.ScalarSharedVariable, T.sharedvar.TensorSharedVariable)), \
             'shared_vars must be a list or tuple of numpy arrays, got %s' % type(shared_vars)
-        shared_vars.set_value(numpy_vars) if isinstance(numpy_vars, np.ndarray) else [sv.set_value(nv) for sv, nv in
-                                                                                      zip(shared_vars, numpy_vars)]
+        if isinstance(numpy_vars, np.ndarray):
+            shared_vars.set_value(numpy_vars, borrow=borrow)
+        else:
+            if num_workers > 1:
+                # the shared variables are independent, so their updates can run in any order
+                executor = _set_value_executor(num_workers)
+                list(executor.map(lambda sv, nv: sv.set_value(nv, borrow=borrow), shared_vars, numpy_vars))
+            else:
+                for sv, nv in zip(shared_vars, numpy_vars):
+                    sv.set_value(nv, borrow=borrow)
     else:
-        shared_vars = placeholder(numpy_vars.shape, numpy_vars.dtype, numpy_vars) if isinstance(numpy_vars,
-                                                                                                np.ndarray) else [
-            placeholder(var.shape, var.dtype, var) for var in numpy_vars]
+        shared_vars = placeholder(numpy_vars.shape, numpy_vars.dtype, numpy_vars, borrow=borrow) if isinstance(
+            numpy_vars, np.ndarray) else [placeholder(var.shape, var.dtype, var, borrow=borrow) for var in numpy_vars]
         return shared_vars
 
 
-def shared2numpy(shared_vars):
+def shared2numpy(shared_vars, borrow=False):
+    """
+    Returns the values of shared variables as numpy arrays.
+
+    :param shared_vars: a shared variable or a list/tuple of shared variables
+    :param borrow: whether the returned arrays may alias the internal storage. Only set if they are not modified
+    :return: a numpy array or a list of numpy arrays
+    """
     assert isinstance(shared_vars, (list, tuple, T.sharedvar.ScalarSharedVariable,
                                     T.sharedvar.TensorSharedVariable)), 'shared_vars must be a shared var, list ' \
                                                                         'or tuple of numpy arrays, got %s' % type(
         shared_vars)
-    return [np.array(sv.get_value()) for sv in shared_vars] if isinstance(shared_vars,
-                                                                          (list, tuple)) else shared_vars.get_value()
+    return [sv.get_value(borrow=borrow) for sv in shared_vars] if isinstance(
+        shared_vars, (list, tuple)) else shared_vars.get_value(borrow=borrow)
 
 
-def load_batch_checkpoints(files, weights):
-    from itertools import chain
-    weights_np = list(chain(*[pkl.load(open(file, 'rb')) for file in files]))
+def _set_weights(weights, weights_np):
     for w_np, w in zip(weights_np, weights):
-        if w.get_value().shape != w_np.shape:
+        if w.get_value(borrow=True, return_internal_type=True).shape != w_np.shape:
             raise ValueError('No suitable weights for %s' % w)
         else:
-            w.set_value(w_np)
+            # w_np was just loaded from disk and is not referenced anywhere else
+            w.set_value(w_np, borrow=True)
+
+
+def _load_npz(file):
+    with np.load(file) as f:
+        return [f['arr_%d' % i] for i in range(len(f.files))]
+
+
+def load_batch_checkpoints(files, weights):
+    import pickle as pkl
+
+    # files are loaded one at a time so that only one of them is held in memory
+    weights = iter(weights)
+    for file in files:
+        if file.endswith('.npz'):
+            weights_np = _load_npz(file)
+        else:
+            with open(file, 'rb') as f:
+                weights_np = pkl.load(f)
+
+        _set_weights(weights, weights_np)
+        del weights_np
+
+
+def save_weights(weights, file):
+    """
+    Saves the values of shared variables as raw arrays in an uncompressed `.npz` file, without pickling them.
+
+    :param weights: a list of shared variables
+    :param file: path of the file. `.npz` is appended if missing
+    """
+    np.savez(file, *[w.get_value(borrow=True) for w in weights])
+
+
+def load_weights(weights, file):
+    """
+    Loads the values written by :func:`save_weights` into shared variables.
+
+    :param weights: a list of shared variables, in the order they were saved
+    :param file: path of the `.npz` file
+    """
+    _set_weights(iter(weights), _load_npz(file))
 
 
 def p_normalize(v, p=2, eps=1e-12):
@@ -1153,6 +1501,11 @@ def p_normalize(v, p=2, eps=1e-12):
 
 
 def p_norm(v, p=2, axis=None):
+    # the common norms avoid pow, which is exp(log(.) * p) on most backends
+    if p == 2:
+        return T.sqrt(T.sum(v * v, axis=axis))
+    if p == 1:
+        return T.sum(abs(v), axis=axis)
     return T.sum(v ** p, axis=axis) ** np.float32(1 / p)
 
 
@@ -1167,35 +1520,59 @@ def max_singular_value(W, u=None, lp=1):
 
     if u is None:
         u = theano.shared(np.random.normal(size=(1, W.get_value().shape[0])).astype(theano.config.floatX), 'u')
-    _u = u
+    uW = T.dot(u, W)
     for _ in range(lp):
-        _v = p_normalize(T.dot(_u, W))
+        _v = p_normalize(uW)
         _u = p_normalize(T.dot(_v, W.T))
-    sigma = T.sum(T.dot(T.dot(_u, W), _v.T))
+        uW = T.dot(_u, W)
+    # u W v^T with uW and v both of shape (1, m)
+    sigma = T.sum(uW * _v)
     return sigma, _u, _v
 
 
+# power iteration vectors of spectral_normalize, kept per weight so that the iteration continues across calls
+_spectral_u = weakref.WeakKeyDictionary()
+
+
 def spectral_normalize(W, u_=None):
-    u = theano.shared(np.random.normal(size=(1, W.get_value().shape[0])).astype(theano.config.floatX),
-                      'u') if u_ is None else u_
+    u = u_
+    if u is None:
+        u = _spectral_u.get(W)
+        if u is None:
+            u = theano.shared(np.random.normal(size=(1, W.get_value().shape[0])).astype(theano.config.floatX), 'u')
+            _spectral_u[W] = u
     sigma, _u, _ = max_singular_value(W, u)
-    W /= (sigma + 1e-12)
+    # one scalar reciprocal, then a multiply over W instead of a divide
+    inv_sigma = np.float32(1) / (sigma + np.float32(1e-12))
+    W = W * inv_sigma
     return (W, _u) if u_ else (W, _u, u)
 
 
 def make_one_hot(label, dim):
-    num = label.shape[0]
-    one_hot = T.zeros((num, dim), theano.config.floatX)
-    one_hot = T.set_subtensor(one_hot[T.arange(num), label], 1.)
-    return one_hot
+    # gathering rows of the identity avoids the zeros and the scatter. T.extra_ops.to_one_hot is not an alternative:
+    # it is built from exactly that zeros + set_subtensor pair
+    return T.eye(dim, dtype=theano.config.floatX)[label]
 
 
-def placeholder(shape=None, dtype=theano.config.floatX, value=None, name=None, borrow=None):
+def placeholder(shape=None, dtype=theano.config.floatX, value=None, name=None, borrow=None, zero=None):
+    """
+    Creates a shared variable holding `value`, or a buffer of the given shape.
+
+    :param shape: shape of the buffer. Ignored if `value` is given
+    :param dtype: data type of the shared variable
+    :param value: initial value
+    :param name: name of the shared variable
+    :param borrow: whether the shared variable may alias the initial value
+    :param zero: whether a buffer created from `shape` is zero-filled. Defaults to True unless `borrow` is True, in
+    which case the buffer is left uninitialized and must be filled with `set_value` before it is read
+    :return: a shared variable
+    """
     assert shape is not None or value is not None, 'Either \'shape\' or \'value\' must be provided.'
     if value is not None:
         x = theano.shared(np.cast[dtype](value), name, borrow=borrow)
     else:
-        x = theano.shared(np.zeros(shape, dtype), name, borrow=borrow)
+        zero = not borrow if zero is None else zero
+        x = theano.shared(np.zeros(shape, dtype) if zero else np.empty(shape, dtype), name, borrow=borrow)
     return x
 
 
@@ -1379,6 +1756,8 @@ def scatter_nd(indices, updates, shape):
     return out
 
 
+# layers call their activation with all of their own kwargs (output_shape, maxout_size, ...), so every entry has to
+# accept and ignore arbitrary kwargs. Binding the Theano ops directly would make them raise TypeError.
 function = {'relu': lambda x, **kwargs: T.nnet.relu(x), 'sigmoid': lambda x, **kwargs: T.nnet.sigmoid(x),
             'tanh': lambda x, **kwargs: T.tanh(x), 'lrelu': lrelu, 'softmax': lambda x, **kwargs: T.nnet.softmax(x),
             'linear': lambda x, **kwargs: x, 'elu': lambda x, **kwargs: T.nnet.elu(x), 'ramp': ramp, 'maxout': maxout,
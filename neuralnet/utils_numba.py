@@ -0,0 +1,59 @@
+'''
+Numba versions of numpy preprocessing helpers in utils.py.
+Requires Numba.
+'''
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+__all__ = ['point_op_np', 'gaussian2_np']
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _point_op_kernel(image, lut, origin, increment, out):
+    lutsize = lut.size - 2
+    for i in prange(image.size):
+        pos = (image[i] - origin) / increment
+        index = min(max(int(pos), 0), lutsize)
+        out[i] = lut[index] + (lut[index + 1] - lut[index]) * (pos - index)
+
+
+def point_op_np(image, lut, origin, increment, dtype='float32'):
+    """
+    Numpy counterpart of :func:`neuralnet.utils.point_op`. Maps every pixel through a look-up table with linear
+    interpolation between the table entries.
+
+    :param image: a numpy array
+    :param lut: a 1D numpy array
+    :param origin: input value of the first table entry
+    :param increment: input step between two table entries
+    :param dtype: data type of the output
+    :return: a numpy array of the same shape as `image`
+    """
+    out = np.empty(image.shape, dtype)
+    _point_op_kernel(np.ascontiguousarray(image).reshape(-1), np.ascontiguousarray(lut), origin, increment,
+                     out.reshape(-1))
+    return out
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def gaussian2_np(size, sigma):
+    """
+    Numba counterpart of :func:`neuralnet.utils.gaussian2`. Evaluates the kernel in a single pass over the grid.
+
+    :param size: width and height of the kernel
+    :param sigma: standard deviation of the gaussian
+    :return: a `size` x `size` float32 numpy array
+    """
+    out = np.empty((size, size), np.float32)
+    s2 = 2. * sigma * sigma
+    A = 1. / (math.pi * s2)
+    offset = -size // 2 + 1
+    for i in prange(size):
+        y = i + offset
+        for j in range(size):
+            x = j + offset
+            out[i, j] = A * math.exp(-(x * x + y * y) / s2)
+    return out
@@ -49,7 +49,8 @@ def setup_package():
         ],
         platforms=['Windows', 'Linux'],
         packages=find_packages(exclude=['examples']),
-        install_requires=['theano', 'matplotlib', 'scipy', 'numpy', 'tqdm', 'visdom'],
+        install_requires=['theano', 'matplotlib', 'scipy', 'numpy', 'tqdm', 'visdom', 'opencv-python'],
+        extras_require={'numba': ['numba']},
         project_urls={
             'Bug Reports': 'https://github.com/justanhduc/neuralnet/issues',
             'Source': 'https://github.com/justanhduc/neuralnet/',